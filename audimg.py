@@ -9,7 +9,6 @@ Data preprocessing, classifier training, result grouping, result plotting
 
 import mvpa2.suite as P
 import numpy as np
-import bids.grabbids as gb
 import os
 import os.path
 from os.path import join as opj
@@ -17,20 +16,42 @@ from os.path import split as spl
 import csv
 import glob
 import pickle
-from scipy.stats import wilcoxon, ttest_rel, ttest_ind, mannwhitneyu
+import re
+import hashlib
+import tempfile
+import bisect
+import shutil
+import time
+import json
+from contextlib import contextmanager
+from collections import OrderedDict
+try:
+    from collections.abc import Mapping
+except ImportError: # Python 2
+    from collections import Mapping
+from scipy.stats import wilcoxon, ttest_rel, ttest_ind, mannwhitneyu, norm
+from scipy.stats import t as student_t
 from statsmodels.stats.multitest import multipletests
 import sys
 from mvpa2.clfs.skl.base import SKLLearnerAdapter
 from sklearn.linear_model import Lasso
+from sklearn.svm import SVC
+from sklearn.base import clone
 from sklearn.metrics import f1_score
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import pprint
+try:
+    import resource
+except ImportError: # not on Windows
+    resource = None
 #import pdb
 
 pl = P.pl # convenience for access to plotting functions
 
 # data = 3mmx3mmx3mm
 
-ROOTDIR='/isi/music/auditoryimagery2'
+ROOTDIR=os.environ.get('AUDIMG_ROOTDIR', '/isi/music/auditoryimagery2') # AUDIMG_ROOTDIR overrides, e.g. for audimg_bench.py
 DATADIR=opj(ROOTDIR, 'am2/data/fmriprep/fmriprep/')
 RESULTSTEM='results_audimg_subj_task_SVDMAP'
 RESULTDIR=opj(ROOTDIR, '%s_del0_dur1_n1000_autoenc'%RESULTSTEM)
@@ -38,8 +59,25 @@ AUTOENCDIR=opj(ROOTDIR, 'seanfiles/strat1')
 SVDFRAC=0.95
 MRISPACE= 'MNI152NLin2009cAsym' # if using fmriprep_2mm then MRISPACE='MNI152NLin6Asym' 
 PARCELLATION='desc-aparcaseg_dseg'# per-subject ROI parcellation in MRISPACE
+BOLD='desc-preproc_bold' # preprocessed BOLD suffix in MRISPACE
 
 N_NULL=10 # number of null models to run
+LOAD_JOBS=4 # number of threads decoding BOLD runs in get_subject_ds
+PRECISION=os.environ.get('AUDIMG_PRECISION') or None # sample dtype from NIfTI load to classification, e.g. 'float32' (halves memory), None: as loaded, float64 after z-scoring
+CLF_BACKENDS=['svm','ridge','kernel'] # 'svm': P.LinearCSVMC (or given clf), 'ridge': closed-form ridge / LDA, all null models in one pass
+                                      # 'kernel': linear C-SVM as P.LinearCSVMC on cached Gram matrices, shared by all null models
+RIDGE_ALPHA=1.0 # ridge penalty, relative to the mean diagonal of the training kernel
+RIDGE_BATCH=1000 # null models per matrix product in the ridge backend
+N_JOBS=int(os.environ.get('PBS_NUM_PPN', 1)) # worker processes for null models (qsub ppn)
+NULL_SEED=0 # null model i draws its permutations from np.random.RandomState([NULL_SEED, i])
+NULL_H=10 # adaptive null models stop after NULL_H null accuracies >= the true accuracy (Besag-Clifford)
+NULL_BLOCK=50 # adaptive null models run in blocks of NULL_BLOCK, 2*NULL_BLOCK, 4*NULL_BLOCK, ..., mn0 is the mean of the first block
+CELL_CACHE=1 # 1: SVD mappers and 'kernel' Gram matrices are computed once per cell and testing partition, kept on the encoded cell dataset (see _cell_cache), 0: once per fit
+TARGET_CACHE_SIZE=64 # encoded target indices kept by _get_task_condition_index, 0 disables the cache
+SVM_TOL=5e-5 # 'kernel' backend SVM stopping tolerance (libsvm epsilon), as P.LinearCSVMC
+RESULTSTORE='res_store' # columnar result store, sub-directory of a result directory
+IO_JOBS=8 # threads reading result parts in load_all_subj_res_from_parts
+TRACE=int(os.environ.get('AUDIMG_TRACE', 0)) # 1: record per-stage wall / cpu time and peak RSS, see trace_stage
 
 # choice of statistical tests
 _TTESTS = {
@@ -52,6 +90,41 @@ _TTESTS = {
 
 TTEST = _TTESTS['ind']
 
+def _wilcoxon(d):
+    """
+    Utility function
+    Column-wise wilcoxon(d[:,j]) for all columns of d in one pass
+    (zero_method='wilcox', normal approximation with tie correction, no continuity correction)
+
+    inputs:
+        d - differences (n_samples x n_tests)
+    outputs:
+        T, p - arrays of wilcoxon statistics and two-sided p-values (n_tests,)
+    """
+    d = np.asarray(d, dtype='float64').reshape(len(d), -1)
+    valid = d!=0 # zero differences are dropped
+    a = np.abs(d)
+    below = ((a[np.newaxis,:,:] < a[:,np.newaxis,:]) & valid[np.newaxis,:,:]).sum(1) # valid |d_j| < |d_i|
+    ties = ((a[np.newaxis,:,:] == a[:,np.newaxis,:]) & valid[np.newaxis,:,:]).sum(1) # valid |d_j| == |d_i|
+    r = below + (ties+1) / 2. # average ranks of |d| among valid differences
+    T = np.minimum(((d>0)*r).sum(0), ((d<0)*r).sum(0))
+    count = valid.sum(0)
+    mn = count * (count + 1.) * 0.25
+    se = count * (count + 1.) * (2. * count + 1.)
+    se -= 0.5 * (valid*(ties*ties - 1)).sum(0) # sum over tie groups of t(t^2-1)
+    se = np.sqrt(se / 24)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = 2. * norm.sf(np.abs((T - mn) / se))
+    return T, p
+
+# column-wise versions of _TTESTS, for calc_group_results
+_TTESTS_VEC = {
+    'rel': lambda a, b: ttest_rel(a,b,axis=0),
+    'ind': lambda a, b: ttest_ind(a,b,axis=0),
+    'welch': lambda a, b: ttest_ind(a,b,equal_var=False,axis=0),
+    'wilcoxon': lambda a,b : _wilcoxon(a-b),
+}
+
 # List of tasks to evaluate
 tasks=['pch-height','pch-class','pch-hilo','timbre','pch-helix-stim-enc','pch-classX','timbreX']
 
@@ -61,10 +134,11 @@ def _set_resultdir(resultdir, rootdir=ROOTDIR, update=True):
         RESULTDIR=opj(ROOTDIR, resultdir)
     return opj(ROOTDIR, resultdir)
 
-def set_resultdir_by_params(delay=0, dur=1, n_null=N_NULL, autoenc=False, svdmap=0.0, update=True):
+def set_resultdir_by_params(delay=0, dur=1, n_null=N_NULL, autoenc=False, svdmap=0.0, update=True, adaptive=False):
     autoenc = '_autoenc' if autoenc else ''
     svdmap = '_svd%3.2f'%svdmap if svdmap>0.0 else ''
-    resultdir = '%s_del%d_dur%d_n%d%s%s'%(RESULTSTEM, delay, dur,n_null,svdmap,autoenc)
+    adaptive = '_adapt' if adaptive else '' # n_null is a maximum, results are not pooled with fixed-size null runs
+    resultdir = '%s_del%d_dur%d_n%d%s%s%s'%(RESULTSTEM, delay, dur,n_null,adaptive,svdmap,autoenc)
     return _set_resultdir(resultdir, update=update)
 
 def _make_subj_id_maps():
@@ -218,8 +292,287 @@ def get_LH_roi_keys():
     """
     return sorted (roi_map.keys())[:len(roi_map.keys())/2] # LH only
 
+def _atomic_write(fname, write, mode='wb'):
+    """
+    Utility function
+    Write fname via a temporary file in the same directory, then rename it into place
+    Readers never see a partially written file, concurrent writers never clobber each other
+
+    inputs:
+        fname - destination file name
+        write - function taking the open (temporary) file object
+         mode - file mode ['wb']
+    """
+    fd, tmpname = tempfile.mkstemp(prefix='.%s.'%spl(fname)[1], dir=os.path.dirname(os.path.abspath(fname)))
+    try:
+        with os.fdopen(fd, mode) as f:
+            write(f)
+        os.chmod(tmpname, 0o664) # mkstemp is owner-only, caches are shared between jobs
+        os.rename(tmpname, fname) # atomic on POSIX
+    except:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+_trace = {'on':bool(TRACE), 'context':{}, 'records':OrderedDict(), 'peaks':[], 'maxrss':0} # trace_stage state: one record per (context, stage, fields), peak RSS of open stages and of the process
+
+def set_trace_context(**fields):
+    """
+    Set the fields (e.g. subj, task, roi, hemi, cond) added to subsequent trace records
+    """
+    _trace['context'] = fields
+
+def _read_rss_kb():
+    """
+    Utility function
+    (VmRSS, VmHWM) of this process in kB from /proc/self/status, None if not available
+    """
+    try:
+        with open('/proc/self/status', 'rt') as f:
+            vals = dict(l.split(':', 1) for l in f if ':' in l)
+        return int(vals['VmRSS'].split()[0]), int(vals['VmHWM'].split()[0])
+    except (IOError, OSError, KeyError, ValueError):
+        return None
+
+def _reset_peak_rss():
+    """
+    Utility function
+    Reset this process's peak RSS (VmHWM) to its current RSS (Linux >= 4.0), return whether it was reset
+    """
+    try:
+        with open('/proc/self/clear_refs', 'wt') as f:
+            f.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+@contextmanager
+def trace_stage(stage, **fields):
+    """
+    Record wall time, CPU time and memory of a pipeline stage, if tracing is on (TRACE, or run_subj_tasks(trace=1))
+    CPU time includes waited-for child processes (null model workers)
+    Memory (Linux): peak_rss_kb is the process peak RSS during the stage (the peak is reset at stage start,
+    enclosing stages keep their own peak), rss_delta_kb the change in RSS over the stage
+    process_maxrss_kb (and _children_kb) are the process lifetime peaks (getrusage, which the reset also clears,
+    so the peaks seen by earlier stages are kept), on any platform
+    Stages nest, e.g. 'cell' contains 'mask', 'classify' and 'null', 'classify' contains 'encode', 'svd', 'train', 'predict'
+    ('gram' instead of 'svd' in the 'kernel' backend: SVD mapper and Gram matrices)
+    Repeated stages with the same context and fields (e.g. 'train' of every null model of a cell)
+    are aggregated into one record: number of calls n, total wall, cpu time and rss_delta_kb, largest peak_rss_kb
+    Records of stages run inside null model worker processes are not collected
+
+    inputs:
+        stage - stage name
+       fields - extra fields of the record
+    """
+    if not _trace['on']:
+        yield
+        return
+    w0, t0 = time.time(), os.times()
+    mem0 = _read_rss_kb()
+    per_stage = mem0 is not None and _reset_peak_rss()
+    if per_stage:
+        peaks = _trace['peaks']
+        peaks[:] = [max(p, mem0[1]) for p in peaks] # enclosing stages keep the peak reached so far
+        peaks.append(0)
+        _trace['maxrss'] = max(_trace['maxrss'], mem0[1])
+    try:
+        yield
+    finally:
+        t1 = os.times()
+        mem1 = _read_rss_kb() if per_stage else None
+        peak = _trace['peaks'].pop() if per_stage else None
+        key = dict(_trace['context'])
+        key.update(fields)
+        key['stage'] = stage
+        key = tuple(sorted(key.items()))
+        rec = _trace['records'].get(key)
+        if rec is None:
+            rec = _trace['records'][key] = dict(key, n=0, wall=0., cpu=0.)
+        rec['n'] += 1
+        rec['wall'] += time.time() - w0
+        rec['cpu'] += sum(t1[:4]) - sum(t0[:4])
+        if mem1 is not None:
+            rec['peak_rss_kb'] = max(rec.get('peak_rss_kb', 0), peak, mem1[1])
+            _trace['maxrss'] = max(_trace['maxrss'], rec['peak_rss_kb'])
+            rec['rss_delta_kb'] = rec.get('rss_delta_kb', 0) + mem1[0] - mem0[0]
+        if resource is not None:
+            rec['process_maxrss_kb'] = max(_trace['maxrss'], resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+            rec['process_maxrss_children_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+def save_trace(fname):
+    """
+    Write the trace records collected so far to fname as JSON lines, and clear them
+    """
+    records, _trace['records'] = _trace['records'], OrderedDict()
+    _atomic_write(fname, lambda f: f.write(''.join(json.dumps(rec, sort_keys=True) + '\n' for rec in records.values())), mode='w')
+
+def load_traces(resultdir=None, by=('stage',)):
+    """
+    Aggregate the trace files (*_trace.jsonl) of a result directory
+
+    inputs:
+      resultdir - directory for results [RESULTDIR]
+             by - record fields to group by [('stage',)]
+    outputs:
+         stats - {group: {'n', 'wall', 'cpu', 'peak_rss_kb', 'process_maxrss_kb'}}, number of stage calls, total wall / cpu seconds,
+                 largest stage peak RSS (0 if not recorded) and largest process lifetime peak RSS per group
+    """
+    resultdir = RESULTDIR if resultdir is None else resultdir
+    stats = {}
+    for fname in sorted(glob.glob(opj(resultdir, '*_trace.jsonl'))):
+        with open(fname, 'rt') as f:
+            for line in f:
+                rec = json.loads(line)
+                st = stats.setdefault(tuple(rec.get(k) for k in by), {'n':0, 'wall':0., 'cpu':0., 'peak_rss_kb':0, 'process_maxrss_kb':0})
+                st['n'] += rec.get('n', 1)
+                st['wall'] += rec['wall']
+                st['cpu'] += rec['cpu']
+                st['peak_rss_kb'] = max(st['peak_rss_kb'], rec.get('peak_rss_kb', 0))
+                st['process_maxrss_kb'] = max(st['process_maxrss_kb'], rec.get('process_maxrss_kb', rec.get('maxrss_kb', 0)))
+    return stats
+
+# fmriprep derivative file names, e.g.
+# sub-sid001401_task-pitchheardXtrumXE_run-01_space-MNI152NLin2009cAsym_desc-preproc_bold.nii.gz
+_BIDS_RE = re.compile(r'sub-(?P<subject>[^_]+)_.*?run-(?P<run>[0-9]+)(?:_space-(?P<space>[^_]+))?(?:_res-[^_]+)?_(?P<suffix>.+?)\.nii(?:\.gz)?$')
+_bids_index = {} # in-memory BIDS indexes, by derivatives path
+
+def _bids_index_filename(path):
+    """
+    Utility function
+    Location of the persistent BIDS index for derivatives path
+    """
+    return opj(ROOTDIR, 'bids_index_%s.pickle'%hashlib.md5(os.path.abspath(path).encode('utf-8')).hexdigest()[:8])
+
+def _build_bids_index(path):
+    """
+    Utility function
+    Crawl path/sub-*/func once and map (subject, run, space, suffix) to file names
+
+    outputs:
+        index - {'path':path, 'mtimes':{dir:mtime}, 'files':{(subject, run, space, suffix):filename}}
+    """
+    mtimes = {path: os.stat(path).st_mtime}
+    files = {}
+    for subdir in sorted(glob.glob(opj(path, 'sub-*'))):
+        mtimes[subdir] = os.stat(subdir).st_mtime
+        funcdir = opj(subdir, 'func')
+        if not os.path.isdir(funcdir):
+            continue
+        mtimes[funcdir] = os.stat(funcdir).st_mtime
+        for fname in sorted(os.listdir(funcdir)):
+            m = _BIDS_RE.match(fname)
+            if m is not None:
+                key = (m.group('subject'), int(m.group('run')), m.group('space'), m.group('suffix'))
+                files.setdefault(key, opj(funcdir, fname))
+    return {'path':path, 'mtimes':mtimes, 'files':files}
+
+def _check_bids_index(index):
+    """
+    Utility function
+    Return True if no indexed directory has changed since the index was built
+    """
+    try:
+        return all(os.stat(d).st_mtime == t for d, t in index['mtimes'].items())
+    except OSError: # indexed directory removed
+        return False
+
+def get_bids_index(path=DATADIR, rebuild=False):
+    """
+    Return the persistent (subject, run, space, suffix) -> filename index of fmriprep derivatives
+    The index is built once, saved next to ROOTDIR, and rebuilt when a directory mtime changes
+
+    inputs:
+        path    - fmriprep derivatives directory [DATADIR]
+        rebuild - force a crawl of the derivatives tree [False]
+
+    outputs:
+        index   - {'path':path, 'mtimes':{dir:mtime}, 'files':{(subject, run, space, suffix):filename}}
+    """
+    if not rebuild and path in _bids_index:
+        return _bids_index[path]
+    index_filename = _bids_index_filename(path)
+    index = None
+    if not rebuild and os.path.exists(index_filename):
+        try:
+            with open(index_filename, 'rb') as f:
+                index = pickle.load(f)
+        except Exception:
+            index = None
+        if index is not None and (index.get('path') != path or not _check_bids_index(index)):
+            index = None
+    if index is None:
+        index = _build_bids_index(path)
+        try:
+            _atomic_write(index_filename, lambda f: pickle.dump(index, f, pickle.HIGHEST_PROTOCOL))
+        except (IOError, OSError):
+            print("Warning: cannot write BIDS index %s"%index_filename)
+    _bids_index[path] = index
+    return index
+
+def get_bids_file(subject, run, suffix, space=MRISPACE, path=DATADIR):
+    """
+    Look up a subject's fmriprep derivative file in the BIDS index
+
+    inputs:
+        subject  - sid00[0-9]{4}
+        run      - run number [1-8]
+        suffix   - file suffix, e.g. BOLD or PARCELLATION
+        space    - MRI space [MRISPACE]
+        path     - fmriprep derivatives directory [DATADIR]
+
+    outputs:
+        filename - full path to the derivative file
+    """
+    try:
+        return get_bids_index(path)['files'][(subject, run, space, suffix)]
+    except KeyError:
+        raise IOError("No %s file for subject %s run %d space %s in %s"%(suffix, subject, run, space, path))
+
+def _save_mmap_ds(ds, stem):
+    """
+    Utility function
+    Save a dataset as an uncompressed, memory-mappable cache:
+       stem.npy          - raw samples array
+       stem.attrs.pickle - sidecar with sample, feature and dataset attributes (targets, chunks, volume geometry)
+    Both files are written atomically, the sidecar last, so it marks a complete cache entry
+    """
+    samples = np.ascontiguousarray(ds.samples)
+    attrs = {'shape': samples.shape, 'dtype': samples.dtype.str,
+             'sa': dict((k, ds.sa[k].value) for k in ds.sa.keys()),
+             'fa': dict((k, ds.fa[k].value) for k in ds.fa.keys()),
+             'a': dict((k, ds.a[k].value) for k in ds.a.keys())}
+    _atomic_write(stem+'.npy', lambda f: np.save(f, samples))
+    _atomic_write(stem+'.attrs.pickle', lambda f: pickle.dump(attrs, f, pickle.HIGHEST_PROTOCOL))
+
+def _load_mmap_ds(stem):
+    """
+    Utility function
+    Load a dataset saved by _save_mmap_ds, samples are a read-only np.memmap
+    so concurrent jobs share pages through the OS page cache
+    """
+    with open(stem+'.attrs.pickle', 'rb') as f:
+        attrs = pickle.load(f)
+    samples = np.load(stem+'.npy', mmap_mode='r')
+    if samples.shape != tuple(attrs['shape']) or samples.dtype.str != attrs['dtype']:
+        raise ValueError("cache %s.npy does not match its sidecar"%stem)
+    return P.Dataset(samples, sa=attrs['sa'], fa=attrs['fa'], a=attrs['a'])
 
-def get_subject_ds(subject, cache=False, cache_dir='ds_cache'):
+def _load_run_samples(job):
+    """
+    Utility function
+    Decode one run's BOLD NIfTI straight into its rows of a preallocated samples array
+    Rows are time points, columns are voxels flattened in C order (as P.fmri_dataset)
+
+    inputs:
+        job - (img, samples, start, stop): nibabel image, samples array, first and last+1 row
+    """
+    img, samples, start, stop = job
+    data = np.asanyarray(img.dataobj) # gzip decoding releases the GIL
+    samples[start:stop] = data.reshape(-1, data.shape[-1]).T
+    del data
+
+def get_subject_ds(subject, cache=False, cache_dir='ds_cache', n_jobs=LOAD_JOBS, precision=None):
     """Assemble pre-processed datasets    
     load subject original data (no mask applied)
     optionally cache for faster loading during model training/testing
@@ -229,41 +582,65 @@ def get_subject_ds(subject, cache=False, cache_dir='ds_cache'):
         subject  - sid00[0-9]{4}    
         cache    - whether to use cached datasets [False]
      cache_dir   - where to store / load cached datasets ['ds_cache']
+                   (uncompressed samples, memory-mapped read-only, see _save_mmap_ds)
+        n_jobs   - number of threads decoding runs concurrently [LOAD_JOBS]
+                   runs are decoded into one preallocated samples array,
+                   so peak memory is the dataset plus n_jobs runs in flight
+      precision  - samples dtype, runs are decoded straight into it [None: PRECISION]
+                   if both are None: the NIfTI data dtype
 
     outputs:
         data     - subject original data (no mask applied)
     """
     swap_timbres=[2,1,4,3,6,5,8,7]
-    layout = gb.BIDSLayout(DATADIR)
-    ext = 'desc-preproc_bold.nii.gz'
-    cache_filename = '%s/%s.ds_cache.nii.gz'%(cache_dir, subject)
-    cache_lockname = '%s/%s.ds_cache.lock'%(cache_dir, subject)    
+    precision = PRECISION if precision is None else precision # at call time, as _preprocess_ds
+    cache_stem = opj(cache_dir, '%s%s.ds_cache'%(subject, '' if precision is None else '_'+np.dtype(precision).name))
     cache_fail=False
     if cache:
         try:
-            data=P.Dataset.from_hdf5(cache_filename)        
-        except:
+            data=_load_mmap_ds(cache_stem)
+        except (IOError, OSError, ValueError, EOFError, pickle.UnpicklingError):
             cache_fail=True
     if not cache or cache_fail:
-        data=[]
+        imgs, tgts, chunks = [], [], []
         for run in range(1,9):
             r=run if legend[accessions[subject]][0]=='HT' else swap_timbres[run-1]
-            f=layout.get(subject=subject, extensions=[ext], run=r)[0]
-            tgts=np.loadtxt(opj(ROOTDIR, 'targets', accessions[subject]+'_run-%02d.txt'%r)).astype('int')
-            ds = P.fmri_dataset(f.filename,
-                             targets=tgts,
-                             chunks=run)
-            if not ds.shape[1]:
-                raise ValueError("Got zero mask (no samples)")
-            #print "subject", subject, "chunk", run, "run", r, "ds", ds.shape 
-            data.append(ds)
-        data=P.vstack(data, a=0)
-        if cache and not os.path.exists(cache_lockname):
-            with open(cache_lockname, "w") as f:
-                f.write("audimg lock\n");
-                f.close()
-                P.Dataset.save(data, cache_filename, compression='gzip')
-                os.remove(cache_lockname)
+            img=P.nib.load(get_bids_file(subject, r, BOLD)) # header only, data are decoded below
+            t=np.loadtxt(opj(ROOTDIR, 'targets', accessions[subject]+'_run-%02d.txt'%r)).astype('int')
+            if imgs and img.shape[:3] != imgs[0].shape[:3]:
+                raise ValueError("run %d volume shape %s differs from run 1 %s"%(r, img.shape[:3], imgs[0].shape[:3]))
+            if len(t) != img.shape[3]:
+                raise ValueError("run %d has %d targets for %d volumes"%(r, len(t), img.shape[3]))
+            imgs.append(img)
+            tgts.append(t)
+            chunks.append(np.ones(len(t), dtype='int')*run)
+        # geometry (mapper, voxel_indices, affine, header) from a single-volume template of the first run
+        template = P.fmri_dataset(imgs[0].__class__(np.asanyarray(imgs[0].dataobj[..., :1]), imgs[0].affine, imgs[0].header))
+        if not template.shape[1]:
+            raise ValueError("Got zero mask (no samples)")
+        bounds = np.r_[0, np.cumsum([len(tgt) for tgt in tgts])]
+        samples = np.empty((bounds[-1], template.shape[1]), dtype=template.samples.dtype if precision is None else precision)
+        pool = ThreadPool(max(1, min(n_jobs, len(imgs))))
+        try:
+            pool.map(_load_run_samples, [(run_img, samples, bounds[i], bounds[i+1]) for i, run_img in enumerate(imgs)], chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        time_indices = np.hstack([np.arange(len(tgt)) for tgt in tgts])
+        tr = imgs[0].header.get_zooms()[3] if len(imgs[0].header.get_zooms()) > 3 else 1.0
+        data = P.Dataset(samples,
+                         sa={'targets':np.hstack(tgts), 'chunks':np.hstack(chunks),
+                             'time_indices':time_indices, 'time_coords':time_indices*tr},
+                         fa=dict((k, template.fa[k].value) for k in template.fa.keys()),
+                         a=dict((k, template.a[k].value) for k in template.a.keys()))
+        #print "subject", subject, "ds", data.shape
+        if cache:
+            if not os.path.isdir(cache_dir):
+                try:
+                    os.makedirs(cache_dir)
+                except OSError: # created by a concurrent job
+                    pass
+            _save_mmap_ds(data, cache_stem) # no lock: temp-file-and-rename, last writer wins
     data.subject = subject # inject subject id into ds
     return data
 
@@ -297,11 +674,62 @@ def inspect_bold_data(data):
     pl.axis('tight')
     _=pl.grid()
 
+_target_index = OrderedDict() # encoded sample indices and targets, least recently used first, see _get_task_condition_index
+
+def _get_task_condition_index(targets, chunks, subj, task, cond, delay=0):
+    """
+    Utility function
+    Sample indices and encoded targets of _encode_task_condition_targets (dur=1) for a subject's
+    sample attributes, computed once and shared by all rois, null models and repeated calls
+    (masked datasets of a subject all have the same targets and chunks)
+
+    inputs:
+      targets, chunks - sample attributes of the (masked) dataset
+      subj, task, cond, delay - as _encode_task_condition_targets
+    outputs:
+        idx - indices of the task / condition samples
+    targets - encoded targets of those samples (read-only)
+    """
+    key = (subj, task, cond, delay, _digest(targets), _digest(chunks))
+    index = _target_index.pop(key, None)
+    if index is None:
+        if delay>0: # shift the targets relative to the BOLD response
+            targets = np.r_[ np.zeros(delay), targets[:-delay] ]
+        idx = np.where( (targets>99) & (targets<1000) )[0] # take only pitch targets
+        targets, chunks = targets[idx], chunks[idx]
+        if 'pch-class' in task: 
+            key_ref = 52 if tonalities[subj]=='E' else 53
+            targets = ((targets - key_ref) % 100) % 12 # shift to relative common reference
+        elif 'pch-hilo' in task: 
+            targets = (targets % 100)
+            keep = (targets<=66) | (targets>75)
+            idx, targets, chunks = idx[keep], targets[keep], chunks[keep]
+            targets[targets<=66]=1
+            targets[targets>75]=2
+        elif 'timbre' in task:
+            targets = chunks % 2
+        if 'X' not in task: # preserve 'h' and 'i' if cross-decoding
+            keep = None
+            if cond[0]=='h':
+                keep = np.isin(chunks, [1,2,5,6])
+            elif cond[0]=='i':
+                keep = np.isin(chunks, [3,4,7,8])
+            if keep is not None:
+                idx, targets = idx[keep], targets[keep]
+        targets.flags.writeable = False
+        index = idx, targets
+    if TARGET_CACHE_SIZE > 0:
+        _target_index[key] = index
+        while len(_target_index) > TARGET_CACHE_SIZE:
+            _target_index.popitem(last=False)
+    return index
+
 def _encode_task_condition_targets(ds, subj, task, cond, delay=0, dur=1):
     """
     Utility function
     Given a dataset ds, subj, and task, return ds with target encoding for task
     subj is required to map tonalities ('E' or 'F') onto relative pc index
+    For dur=1 the samples are gathered once through the cached _get_task_condition_index
     ds    - masked dataset
     subj  - subject key
     task  - one of tasks[....]
@@ -309,6 +737,12 @@ def _encode_task_condition_targets(ds, subj, task, cond, delay=0, dur=1):
     delay - TRs delay for target conditions          [0]
     dur   - event duration for event-related dataset [1]
     """
+    if dur==1:
+        idx, targets = _get_task_condition_index(ds.targets, ds.chunks, subj, task, cond, delay)
+        ds = ds[idx] # one copy of the selected samples
+        ds.targets = targets.copy()
+        return ds
+
     ds = ds.copy()
 
     if delay>0: # shift the targets relative to the BOLD response
@@ -380,7 +814,7 @@ def _get_stimulus_encoding_ds(ds, subj):
     Make target-encoded dataset, stimulus-encoding dataset for subject
     """
     column = np.argmax(np.abs(ds.samples).mean(0)) # per-voxel modeling, so choose a column (voxel) UNIVARIATE
-    ds_regr = P.Dataset(ds.targets, sa={'targets':ds.samples[:,column],'chunks':ds.chunks})
+    ds_regr = P.Dataset(ds.targets.copy(), sa={'targets':ds.samples[:,column],'chunks':ds.chunks}) # _map_pc_to_helix works in-place
     ds_regr = _map_pc_to_helix(ds_regr, subj) # ds_cv is targets -> 1 voxel
     return ds_regr
 
@@ -402,39 +836,226 @@ def test_stimulus_encoding():
     print "null err:", np.array([P.errorfx.relative_rms_error(res[1][n][1],res[0][0]) for n in range(10)]).mean()
     return res
 
-def do_stimulus_encoding(ds, subj, clf=SKLLearnerAdapter(Lasso(alpha=0.2)), part=0, null_model=False):
+def do_stimulus_encoding(ds, subj, clf=Lasso(alpha=0.2), part=0, null_model=False, rng=None):
     """
     Utility function: CV half partitioner stimulus-encoding model
     Regression to predict a subject's BOLD response to stimulus representation    
+    All voxels share the helix design, so they are fitted at once as one multi-output regression
+    (each voxel is still an independent fit, as with one model per voxel)
 
     inputs:
             ds - a (masked) dataset
           subj - subject id sid00[0-9]{4}
-           clf - regression model [SKLLearnerAdapter(Lasso(alpha=0.1))]
+           clf - sklearn regression model, or SKLLearnerAdapter of one [Lasso(alpha=0.2)]
           part - partition (0 or 1)
     null_model - whether using monte carlo tests [False]
+           rng - random state of the null model [None: np.random]
 
     outputs:    
-          tgts - BOLD data
-          pred - predicted BOLD data
+          tgts - BOLD data (n_test x n_voxels)
+          pred - predicted BOLD data (n_test x n_voxels)
     """
     ds_cv = _get_stimulus_encoding_ds(ds, subj)    # target-filtered ds, swapped ds
-    n=len(ds)
-    ds.partitions = (np.arange(n)>=n/2).astype(int)
+    ds.partitions = _get_partitions(len(ds))
+    train, test = ds.partitions==part, ds.partitions!=part
+    bold = ds.samples
     if null_model:
         # Separate permuted training targets from true targets used for testing
-        ds.samples[ds.partitions==part] = np.random.permutation(ds.samples[ds.partitions==part]) 
-    tgts=[]
-    preds=[]
-    for voxel in ds.samples.T:
-        ds_cv.targets = voxel
-        clf.train(ds_cv[ds.partitions==part])    
-        pred = clf.predict(ds_cv[ds.partitions!=part])
-        tgts.append(voxel[ds.partitions!=part])
-        preds.append(pred)
-    return np.array(tgts).T, np.array(preds).T
-
-def _cv_run(ds, clf, part=0, null_model=False, svdmap=0.0):            
+        rng = np.random if rng is None else rng
+        bold = bold.copy() # ds is left intact
+        bold[train] = rng.permutation(bold[train]) 
+    reg = clone(clf._clf if isinstance(clf, SKLLearnerAdapter) else clf)
+    reg.fit(ds_cv.samples[train], bold[train])
+    pred = reg.predict(ds_cv.samples[test]).reshape(test.sum(), -1)
+    return bold[test], pred
+
+def _get_partitions(n):
+    """
+    Utility function
+    CV half partitions for n samples: first half 0, second half 1
+    """
+    return (np.arange(n)>=n//2).astype(int)
+
+def _ridge_hat(X_train, X_test, alpha=RIDGE_ALPHA, svdmap=0.0):
+    """
+    Utility function
+    Hat matrix of closed-form (dual) ridge regression with intercept
+    test predictions are H (Y_train - Y_train.mean(0)) + Y_train.mean(0) for any training targets Y_train
+
+    inputs:
+       X_train - training samples
+        X_test - testing samples
+         alpha - ridge penalty, relative to the mean kernel diagonal [RIDGE_ALPHA]
+        svdmap - proportion of training svd components to use, as P.SVDMapper [0.0]
+
+    outputs:
+             H - hat matrix (n_test x n_train)
+    """
+    X_train = np.asarray(X_train, dtype='float64')
+    mu = X_train.mean(0)
+    Xc = X_train - mu
+    K = np.dot(Xc, Xc.T)
+    Kt = np.dot(np.asarray(X_test, dtype='float64') - mu, Xc.T)
+    if svdmap > 0.0: # project onto the leading svd components of the training partition
+        r = int(min(X_train.shape)*svdmap)
+        w, U = np.linalg.eigh(K)
+        w, U = w[::-1][:r], U[:, ::-1][:, :r]
+        K = np.dot(U*w, U.T)
+        Kt = np.dot(np.dot(Kt, U), U.T)
+    lam = alpha * np.trace(K) / len(K)
+    lam = lam if lam > 0 else alpha
+    return np.linalg.solve(K + lam*np.eye(len(K)), Kt.T).T # K is symmetric
+
+def _ridge_cv_run(ds, part=0, n_null=0, svdmap=0.0, alpha=RIDGE_ALPHA, rngs=None):
+    """
+    Utility function: CV half partitioner for the closed-form ridge / LDA backend
+    One-vs-rest ridge regression onto class indicators, predicting the class with the largest score
+    The hat matrix depends only on the training samples, so the true targets and 
+    all n_null permutations of the training targets are scored in batched matrix products
+
+    inputs:
+            ds - a (masked) dataset
+          part - testing partition (0 or 1) [0]
+        n_null - number of permutations of the training targets to score [0]
+        svdmap - proportion of svd components to use [0.0]
+         alpha - ridge penalty [RIDGE_ALPHA]
+          rngs - per-permutation random states [None: np.random]
+
+    outputs:
+          tgts - test targets
+          pred - predicted test targets
+    null_preds - predicted test targets for each permutation (n_null x n_test)
+    """
+    partitions = _get_partitions(len(ds))
+    train, test = partitions!=part, partitions==part # part is test partition
+    H = _ridge_hat(ds.samples[train], ds.samples[test], alpha, svdmap)
+    classes = np.unique(ds.targets[train])
+    Y = (ds.targets[train][:,np.newaxis]==classes).astype('float64')
+    Ym = Y.mean(0) # class frequencies are invariant to permutation
+    Y -= Ym
+    pred = classes[np.argmax(np.dot(H, Y)+Ym, 1)]
+    perms = np.array([(np.random if rngs is None else rngs[i]).permutation(len(Y)) for i in range(n_null)], dtype='int').reshape(n_null, len(Y))
+    null_preds = []
+    for b in range(0, n_null, RIDGE_BATCH):
+        Yp = Y[perms[b:b+RIDGE_BATCH]] # n_batch x n_train x n_classes
+        scores = np.dot(H, Yp.transpose(1,0,2).reshape(len(Y), -1)).reshape(H.shape[0], len(Yp), -1) + Ym
+        null_preds.append(classes[np.argmax(scores, 2)].T)
+    null_preds = np.vstack(null_preds) if null_preds else np.zeros((0, H.shape[0]), dtype=classes.dtype)
+    return ds.targets[test], pred, null_preds
+
+def _digest(a):
+    """
+    Utility function
+    Content key of array a (shape, dtype, sha1 of data)
+    """
+    a = np.ascontiguousarray(a)
+    return '%s%s%s'%(a.shape, a.dtype.str, hashlib.sha1(a).hexdigest())
+
+def _cell_cache(ds):
+    """
+    Utility function
+    Cache of an encoded (task, cond) cell dataset, for fits that do not depend on the targets
+    It lives on ds, so it is shared by the true and all null models of the cell (inherited by
+    forked null model workers) and freed with the cell, None if CELL_CACHE is off
+    """
+    if not CELL_CACHE:
+        return None
+    if getattr(ds, 'cv_cache', None) is None:
+        ds.cv_cache = {}
+    return ds.cv_cache
+
+def _get_svd_mapper(ds_train, svdmap, cache=None, key=None):
+    """
+    Utility function
+    Trained SVD mapper (P.SVDMapper, then the leading svdmap proportion of components) for ds_train
+    The decomposition does not depend on the targets, so a mapper is trained once per cell and
+    testing partition and shared by all null models
+
+    inputs:
+      ds_train - training dataset
+        svdmap - proportion of svd components to use
+         cache - cell cache, see _cell_cache [None: no caching]
+           key - key of ds_train's training partition in cache, e.g. (task, cond, part)
+
+    outputs:
+        mapper - trained P.ChainMapper
+    """
+    key = ('svd', key, svdmap)
+    if cache is not None and key in cache:
+        return cache[key]
+    mapper = P.ChainMapper([P.SVDMapper(), P.StaticFeatureSelection(slice(0, int(min(ds_train.shape[0],ds_train.shape[1])*svdmap)))])
+    mapper.train(ds_train)
+    if cache is not None:
+        cache[key] = mapper
+    return mapper
+
+def _get_gram(ds, task, cond, part, svdmap=0.0, cache=None):
+    """
+    Utility function
+    Linear kernels of testing partition part: train x train and test x train (after the SVD mapper if svdmap)
+    They do not depend on the targets, so they are computed once per cell and testing partition, and
+    a null model only costs an SVM fit on the n x n kernels
+
+    inputs:
+           ds - an encoded cell dataset (all partitions, see _get_cv_part_ds)
+    task, cond - the cell's task and condition, '' for a dataset that is already the partition's
+         part - testing partition (0 or 1)
+       svdmap - proportion of svd components to use [0.0]
+        cache - cell cache, see _cell_cache [None: no caching]
+    outputs:
+      K_train - train x train Gram matrix
+       K_test - test x train Gram matrix
+      y_train - training targets
+       y_test - testing targets
+    """
+    key = ('gram', task, cond, part, svdmap)
+    if cache is not None and key in cache:
+        return cache[key]
+    ds_part = _get_cv_part_ds(ds, task, cond, part)
+    partitions = _get_partitions(len(ds_part))
+    ds_train, ds_test = ds_part[partitions!=part], ds_part[partitions==part] # part is test partition
+    if svdmap > 0.0:
+        mapper = _get_svd_mapper(ds_train, svdmap, cache, (task, cond, part))
+        ds_train, ds_test = mapper.forward(ds_train), mapper.forward(ds_test)
+    X_train = np.asarray(ds_train.samples, dtype='float64')
+    X_test = np.asarray(ds_test.samples, dtype='float64')
+    K = np.dot(X_train, X_train.T), np.dot(X_test, X_train.T), ds_train.targets.copy(), ds_test.targets.copy()
+    if cache is not None:
+        cache[key] = K
+    return K
+
+def _kernel_cv_run(ds, part=0, null_model=False, svdmap=0.0, rng=None, task='', cond='', cache=None):
+    """
+    Utility function: CV half partitioner for the 'kernel' backend
+    Linear C-SVM on precomputed Gram matrices, with P.LinearCSVMC's default C = 1 / mean(||x||)^2
+    over the training samples (libsvm one-vs-one, as P.LinearCSVMC)
+
+    inputs:
+            ds - an encoded cell dataset, or the dataset of testing partition part if task is ''
+          part - testing partition (0 or 1) [0]
+    null_model - whether using monte carlo tests [False]
+       svdmap  - proportion of svd components to use for SVD Mapper [0.0]
+           rng - random state of the null model [None: np.random]
+    task, cond - the cell's task and condition, see _get_cv_part_ds ['']
+         cache - cell cache, see _cell_cache [None]
+
+    outputs:
+          tgts - test targets
+          pred - predicted test targets
+    """
+    with trace_stage('gram'): # includes the SVD mapper if svdmap
+        K_train, K_test, targets, tgts = _get_gram(ds, task, cond, part, svdmap, cache)
+    if null_model:
+        targets = targets[(np.random if rng is None else rng).permutation(len(targets))] # scramble targets
+    C = 1.0 / np.sqrt(np.maximum(np.diag(K_train), 0)).mean()**2
+    svm = SVC(C=C, kernel='precomputed', tol=SVM_TOL)
+    with trace_stage('train'):
+        svm.fit(K_train, targets)
+    with trace_stage('predict'):
+        pred = svm.predict(K_test)
+    return tgts, pred
+
+def _cv_run(ds, clf, part=0, null_model=False, svdmap=0.0, backend='svm', rng=None, cache=None, key=None):
     """
     Utility function: CV half partitioner with probability estimates
     (resolves incompatibility between P.SVM and P.CrossValidation)
@@ -444,27 +1065,38 @@ def _cv_run(ds, clf, part=0, null_model=False, svdmap=0.0):
            clf - regression model [SKLLearnerAdapter(Lasso(alpha=0.1))]
           part - testing partition (0 or 1) [0]
     null_model - whether using monte carlo tests [False]
+       svdmap  - proportion of svd components to use for SVD Mapper [0.0]
+       backend - classifier backend from CLF_BACKENDS, 'ridge' and 'kernel' ignore clf ['svm']
+           rng - random state of the null model [None: np.random]
+         cache - cell cache for the SVD mapper, see _cell_cache [None]
+           key - key of this testing partition in cache, e.g. (task, cond, part) [None]
 
     outputs:    
           tgts - BOLD data
           pred - predicted BOLD data    
            est - probabilities of predicted labels
     """
+    rng = np.random if rng is None else rng
+    if backend == 'ridge':
+        tgts, pred, null_preds = _ridge_cv_run(ds, part, int(null_model), svdmap, rngs=[rng])
+        return tgts, null_preds[0] if null_model else pred
+    if backend == 'kernel':
+        return _kernel_cv_run(ds, part, null_model, svdmap, rng)
     # 'null_model' : whether using monte carlo tests [False]
     n=len(ds)
-    ds.partitions = (np.arange(n)>=n/2).astype(int)
+    ds.partitions = _get_partitions(n)
     ds_train = ds[ds.partitions!=part] # part is test partition
     ds_test = ds[ds.partitions==part]
     if null_model:
         # Separate permuted training targets from true targets used for testing
-        ds_train.targets = np.random.permutation(ds_train.targets) # scramble targets (TODO 7/28: permute targets within runs?)
-    if svdmap > 0.0:
-        get_SVD_sliced = lambda x: P.ChainMapper([P.SVDMapper(), P.StaticFeatureSelection(x)])
-        mapped_clf = P.MappedClassifier(clf, get_SVD_sliced(slice(0, int(min(ds_train.shape[0],ds_train.shape[1])*svdmap))))
-        mapped_clf.train(ds_train)
-        pred = mapped_clf.predict(ds_test)
-    else:
-        clf.train(ds_train)    
+        ds_train.targets = ds_train.targets[rng.permutation(len(ds_train))] # scramble targets (TODO 7/28: permute targets within runs?)
+    if svdmap > 0.0: # as P.MappedClassifier, with the SVD trained once per training partition
+        with trace_stage('svd'):
+            mapper = _get_svd_mapper(ds_train, svdmap, cache, key)
+            ds_train, ds_test = mapper.forward(ds_train), mapper.forward(ds_test)
+    with trace_stage('train'):
+        clf.train(ds_train)
+    with trace_stage('predict'):
         pred = clf.predict(ds_test)
     #method to explicitly derive SVM predictions from margin-distance (psuedo probability) estimates
     #get_pred=lambda pred: sorted(pred.keys())[np.argmax((np.array([pred[k] for k in sorted(pred.keys())]).reshape(-1,len(pred.keys())-1)>0).sum(1))]
@@ -479,7 +1111,20 @@ def _cv_run(ds, clf, part=0, null_model=False, svdmap=0.0):
     #     est=[] # probability estimates don't work for pch-height, check get_probs 
     return ds_test.targets, pred #, est # TODO 7/28: return stats, est optional (separate function?)
 
-def do_subj_classification(ds_masked, subject, task='timbre', cond='a', clf=None, null_model=False, delay=0, dur=1, svdmap=0.0):
+def _get_cv_part_ds(ds, task, cond, part):
+    """
+    Utility function
+    Dataset for testing partition part: ds, or the cross-decoding runs for 'X' tasks
+    """
+    if 'X' not in task:
+        return ds
+    # cross-decode
+    if cond=='i': # train on h and test on i
+        return ds[np.isin(ds.chunks, [1,2,7,8])] if part==1 else ds[np.isin(ds.chunks, [3,4,5,6])]
+    else: # train on i and test on h
+        return ds[np.isin(ds.chunks, [3,4,5,6])] if part==1 else ds[np.isin(ds.chunks, [1,2,7,8])]
+
+def do_subj_classification(ds_masked, subject, task='timbre', cond='a', clf=None, null_model=False, delay=0, dur=1, svdmap=0.0, backend='svm', n_null=0, rngs=None, encoded=False):
     """
     Classify a subject's data
     
@@ -490,6 +1135,10 @@ def do_subj_classification(ds_masked, subject, task='timbre', cond='a', clf=None
      cond - choose the condition h/i/a
            clf - the classifier (LinearCSVMC)
     null_model - Monte-Carlo permutation test [False]    
+       backend - classifier backend from CLF_BACKENDS ['svm']
+        n_null - 'ridge' backend: number of null models scored in the same pass [0]
+          rngs - random states of the null models, one for null_model, n_null for 'ridge' [None: np.random]
+       encoded - ds_masked is already _encode_task_condition_targets encoded (and is not modified) [False]
 
     outputs:
         dict = {
@@ -500,25 +1149,31 @@ def do_subj_classification(ds_masked, subject, task='timbre', cond='a', clf=None
        'cond' : which condition in {'h','i'}
               'ut' : unique targets for task
       'null_model' : whether using monte carlo tests [False]
+            'null' : 'ridge' backend, n_null x n_trials null-model predictions
        }    
     """
-    tgts, preds = [], [] # , ests= []
-    ds = _encode_task_condition_targets(ds_masked, subject, task, cond, delay, dur) # returns ds_encoded
+    if backend not in CLF_BACKENDS:
+        raise ValueError("backend %s not in CLF_BACKENDS"%backend)
+    tgts, preds, nulls = [], [], [] # , ests= []
+    if encoded:
+        ds = ds_masked
+    else:
+        with trace_stage('encode'):
+            ds = _encode_task_condition_targets(ds_masked, subject, task, cond, delay, dur) # returns ds_encoded
     for part in [0,1]: # test partitions ordering # training is [1,0] in _cv_run, so testing is [0,1]
         if 'stim-enc' in task: # stimulus encoding returns voxel time-series and their predictions
-            clf = SKLLearnerAdapter(Lasso(alpha=0.2))
-            tgt, pred = do_stimulus_encoding(ds, subject, clf, part, null_model)
+            clf = Lasso(alpha=0.2)
+            tgt, pred = do_stimulus_encoding(ds, subject, clf, part, null_model, None if rngs is None else rngs[0])
             #est = [] # no probability estimates for stimulus encoding model
+        elif backend == 'ridge' and n_null and not null_model: # true and null models in one pass
+            tgt, pred, null = _ridge_cv_run(_get_cv_part_ds(ds, task, cond, part), part, n_null, svdmap, rngs=rngs)
+            nulls.append(null)
+        elif backend == 'kernel': # Gram matrices of the cell, no dataset copies per null model
+            tgt, pred = _kernel_cv_run(ds, part, null_model, svdmap, None if rngs is None else rngs[0], task, cond, _cell_cache(ds))
         else: # classification
             clf=P.LinearCSVMC() if clf is None else clf # enable_ca=['probabilities']
-            if 'X' not in task:
-                ds_part = ds
-            else: # cross-decode
-                if cond=='i': # train on h and test on i
-                    ds_part = ds[np.isin(ds.chunks, [1,2,7,8])] if part==1 else ds[np.isin(ds.chunks, [3,4,5,6])]
-                else: # train on i and test on h
-                    ds_part = ds[np.isin(ds.chunks, [3,4,5,6])] if part==1 else ds[np.isin(ds.chunks, [1,2,7,8])]
-            tgt, pred = _cv_run(ds_part, clf, part, null_model, svdmap) # , est
+            ds_part = _get_cv_part_ds(ds, task, cond, part)
+            tgt, pred = _cv_run(ds_part, clf, part, null_model, svdmap, backend, None if rngs is None else rngs[0], _cell_cache(ds), (task, cond, part)) # , est
         tgts.extend(tgt)
         preds.extend(pred)
         #ests.extend(est)
@@ -528,7 +1183,10 @@ def do_subj_classification(ds_masked, subject, task='timbre', cond='a', clf=None
         tgts = np.array(tgts) 
     preds= np.array(preds) 
     #ests = np.array(ests)
-    return {'subj':subject, 'res':[tgts, preds], 'task':task, 'cond':cond, 'ut':ds.UT, 'null_model':null_model} # 'est': ests, 
+    res = {'subj':subject, 'res':[tgts, preds], 'task':task, 'cond':cond, 'ut':ds.UT, 'null_model':null_model} # 'est': ests, 
+    if nulls:
+        res['null'] = np.hstack(nulls)
+    return res
 
 def get_subject_mask(subject, run=1, rois=[1030,2030], path=DATADIR, 
                      space=MRISPACE,
@@ -548,16 +1206,97 @@ def get_subject_mask(subject, run=1, rois=[1030,2030], path=DATADIR,
     outputs:
         mask_ds  - pymvpa Dataset containing mask data {0,[rois]}
     """
-    fname = opj(path, 'sub-%s'%subject, 'func', 'sub-%s_task-*_run-%02d_space-%s_%s.nii.gz'%(subject, run, space, parcellation))
-    #print fname
-    fname = glob.glob(fname)[0]
+    fname = get_bids_file(subject, run, parcellation, space, path)
     ds=P.fmri_dataset(fname)
     found = np.where(np.isin(ds.samples,rois))[1]
     return ds[:,found]
 
+_roi_index = {} # per-subject parcellation tables, by (subject, run, path, space, parcellation)
+
+def get_subject_roi_index(subject, run=1, path=DATADIR,
+                          space=MRISPACE,
+                          parcellation=PARCELLATION):
+    """
+    Get subject's ROI voxel index table, the parcellation is loaded once per subject
+
+    inputs:
+        subject  - sid00[0-9]{4}
+        run      - which run to use for parcellation [1-8]
+        path     - dir containing roi parcellations [DATADIR]
+       space     - parcellation space [MRISPACE]
+     parcellation- file  [PARCELLATION]
+
+    outputs:
+      roi_index  - {roi: sorted feature indices into the subject's unmasked dataset}
+    """
+    key = (subject, run, path, space, parcellation)
+    if key not in _roi_index:
+        labels = P.fmri_dataset(get_bids_file(subject, run, parcellation, space, path)).samples[0].astype('int')
+        order = np.argsort(labels, kind='mergesort') # stable sort keeps feature indices ascending within each label
+        keys, starts = np.unique(labels[order], return_index=True)
+        stops = np.r_[starts[1:], len(order)]
+        _roi_index[key] = dict((int(k), order[a:b]) for k, a, b in zip(keys, starts, stops) if k)
+    return _roi_index[key]
+
+def get_subject_roi_features(subject, rois):
+    """
+    Sorted feature indices of the union of rois in subject's unmasked dataset
+    (same features, in the same order, as applying get_subject_mask with P.fmri_dataset)
+    """
+    roi_index = get_subject_roi_index(subject)
+    return np.unique(np.hstack([roi_index.get(r, np.array([], dtype='int')) for r in np.atleast_1d(rois)]))
+
+def _select_features(ds, features):
+    """
+    Utility function
+    Select feature columns of ds, chaining the selection onto ds's mapper (data is copied)
+    """
+    fsel = P.StaticFeatureSelection(features) # column index, no NIfTI round-trip
+    fsel.train(ds)
+    return ds.get_mapped(fsel)
+
+def _preprocess_ds(ds, detrend=True, zscore=True):
+    """
+    Utility function
+    Voxel-wise detrending and z-scoring of ds (in-place)
+    Samples are returned in PRECISION, if set
+    """
+    if detrend:
+        P.poly_detrend(ds, polyord=1, chunks_attr='chunks') # in-place
+    if zscore:
+        P.zscore(ds, param_est=('targets', [1,2]), dtype=PRECISION or 'float64') # in-place    
+    if PRECISION is not None and ds.samples.dtype != PRECISION: # poly_detrend's fit is float64
+        ds.samples = ds.samples.astype(PRECISION)
+    return ds
+
+def get_preprocessed_subject_ds(ds, subj, detrend=True, zscore=True):
+    """
+    Detrend / z-score the union of all roi_map voxels once per subject dataset
+    Both operations are voxel-wise, so any ROI is a column subset of the result
+    The result is cached on ds, shared by all rois, hemispheres, conditions and tasks
+
+    inputs:
+         ds - the subject's unmasked dataset
+       subj - sid00[0-9]{4}
+    detrend - remove trend from roi dataset [True]
+     zscore - voxel-wise z-scoring of roi dataset [True]
+
+    outputs:
+     features - sorted feature indices of the union of roi_map in ds
+      ds_union - preprocessed dataset of those features
+    """
+    if getattr(ds, 'preproc_cache', None) is None:
+        ds.preproc_cache = {}
+    key = (subj, detrend, zscore, PRECISION)
+    if key not in ds.preproc_cache:
+        features = get_subject_roi_features(subj, sorted(roi_map.keys()))
+        ds.preproc_cache[key] = features, _preprocess_ds(_select_features(ds, features), detrend, zscore)
+    return ds.preproc_cache[key]
+
 def mask_subject_ds(ds, subj, rois, detrend=True, zscore=True):
     """
     Mask a subject's data for given list of rois
+    Rois in roi_map are sliced from the shared get_preprocessed_subject_ds
     
     inputs:
          ds - the dataset to mask
@@ -570,19 +1309,85 @@ def mask_subject_ds(ds, subj, rois, detrend=True, zscore=True):
      ds_masked - the masked dataset (data is copied)
     """
     if subj is not None:
-        mask = get_subject_mask('%s'%subj, run=1, rois=rois)
-        ds_masked=P.fmri_dataset(P.map2nifti(ds), ds.targets, ds.chunks, P.map2nifti(mask))
-        if detrend:
-            P.poly_detrend(ds_masked, polyord=1, chunks_attr='chunks') # in-place
-        if zscore:
-            P.zscore(ds_masked, param_est=('targets', [1,2])) # in-place    
+        subj = '%s'%subj
+        features = get_subject_roi_features(subj, rois)
+        if not (detrend or zscore):
+            return _select_features(ds, features)
+        if np.all(np.isin(rois, list(roi_map.keys()))):
+            union_features, ds_union = get_preprocessed_subject_ds(ds, subj, detrend, zscore)
+            ds_masked = _select_features(ds_union, np.searchsorted(union_features, features))
+        else: # roi outside roi_map, preprocess on its own
+            ds_masked = _preprocess_ds(_select_features(ds, features), detrend, zscore)
     else:
         ds_masked = ds.copy()
     return ds_masked
 
+def _ae_store_stem(subj, autoencdir=AUTOENCDIR):
+    """
+    Utility function
+    Location of subject's packed autoencoder feature store
+    """
+    return opj(autoencdir, '%s.ae_store'%subj)
+
+def pack_autoencoded_subject_ds(subj, rois=None, exts=('lh','rh','lrh'), autoencdir=AUTOENCDIR):
+    """
+    Pack a subject's pickled autoencoded roi datasets into one indexed, memory-mappable store
+    (AUTOENCDIR/subj.ae_store.npy + sidecar, see _save_mmap_ds), read by get_autoencoded_subject_ds
+
+    inputs:
+       subj - sid00[0-9]{4}
+       rois - LH roi keys to pack [get_LH_roi_keys()]
+       exts - which file extensions to pack, missing files are skipped [('lh','rh','lrh')]
+ autoencdir - directory of pickled autoencoded datasets [AUTOENCDIR]
+
+    outputs:
+     ae_index - {(roi, ext): (first, last+1) column of the store}
+    """
+    rois = get_LH_roi_keys() if rois is None else rois
+    blocks, ae_index, targets, chunks = [], {}, None, None
+    col = 0
+    for roi in rois:
+        for ext in exts:
+            fname = opj(autoencdir,'%s/%d/transformed_%s.p'%(subj,roi,ext))
+            if not os.path.exists(fname):
+                continue
+            with open(fname) as f:
+                ds_tmp = pickle.load(f)
+            if ds_tmp.shape[1]==0:
+                raise ValueError('dataset has no samples %s/%d/transformed_%s.p'%(subj,roi,ext))
+            if targets is None:
+                targets, chunks = ds_tmp.targets, ds_tmp.chunks
+            elif not (np.array_equal(targets, ds_tmp.targets) and np.array_equal(chunks, ds_tmp.chunks)):
+                raise ValueError('targets / chunks differ from other rois %s/%d/transformed_%s.p'%(subj,roi,ext))
+            blocks.append(ds_tmp.samples)
+            ae_index[(roi, ext)] = (col, col+ds_tmp.shape[1])
+            col += ds_tmp.shape[1]
+    if not blocks:
+        raise IOError('no autoencoded datasets for %s in %s'%(subj, autoencdir))
+    ds_store = P.Dataset(np.hstack(blocks), sa={'targets':targets, 'chunks':chunks}, a={'ae_index':ae_index})
+    _save_mmap_ds(ds_store, _ae_store_stem(subj, autoencdir))
+    return ae_index
+
+_ae_store = {} # opened autoencoder stores (or None if absent), by store stem
+
+def _get_ae_store(subj, autoencdir=AUTOENCDIR):
+    """
+    Utility function
+    Subject's packed autoencoder store, opened once per process, None if not packed
+    """
+    stem = _ae_store_stem(subj, autoencdir)
+    if stem not in _ae_store:
+        try:
+            _ae_store[stem] = _load_mmap_ds(stem)
+        except (IOError, OSError, ValueError, EOFError, pickle.UnpicklingError):
+            _ae_store[stem] = None
+    return _ae_store[stem]
+
 def get_autoencoded_subject_ds(ds, subj, rois, ext='auto'):
     """
     Fetch a subject's autoencoded data for given list of rois
+    Rois are zero-copy column slices of the packed store (pack_autoencoded_subject_ds),
+    or read from the pickled datasets if the subject is not packed
     
     inputs:
          ds - the dataset to mask
@@ -595,24 +1400,129 @@ def get_autoencoded_subject_ds(ds, subj, rois, ext='auto'):
     """
     auto_ext = ext == 'auto'
     if subj is not None: # if not testing
+        store = _get_ae_store(subj)
         ae_ds = [] # list of autoencoded rois for subj
         for roi in rois:
             if auto_ext:
                 ext = 'lh' if roi < 2000 else 'rh'
             roi = roi if roi < 2000 else roi - 1000
+            if store is not None and (roi, ext) in store.a.ae_index:
+                first, last = store.a.ae_index[(roi, ext)]
+                ae_ds.append(store.samples[:, first:last]) # view of the memory-mapped store
+                targets, chunks = store.targets, store.chunks
+                continue
             with open(opj(AUTOENCDIR,'%s/%d/transformed_%s.p'%(subj,roi,ext))) as f:
                 ds_tmp = pickle.load(f)
-                ae_ds.append(ds_tmp.samples) # autoencoded for given rois
-                if ae_ds[-1].shape[1]==0:
-                    raise ValueError('dataset has no samples %s/%d/transformed_%s.p'%(subj,roi,ext))
-                else:
-                    ds_autoenc = P.dataset_wizard(samples=P.hstack(ae_ds), targets=ds_tmp.targets, chunks=ds_tmp.chunks) 
+            ae_ds.append(ds_tmp.samples) # autoencoded for given rois
+            if ae_ds[-1].shape[1]==0:
+                raise ValueError('dataset has no samples %s/%d/transformed_%s.p'%(subj,roi,ext))
+            targets, chunks = ds_tmp.targets, ds_tmp.chunks
+        samples = ae_ds[0] if len(ae_ds)==1 else np.hstack(ae_ds)
+        if PRECISION is not None:
+            samples = samples.astype(PRECISION, copy=False)
+        ds_autoenc = P.dataset_wizard(samples=samples, targets=targets, chunks=chunks) 
     else: # testing
         ds_autoenc = ds.copy()
     #print("** Found Autoencoded BOLD Data **", subj, rois)
     return ds_autoenc
 
-def do_masked_subject_classification(ds, subj, task, cond, rois=[1030,2030], n_null=N_NULL, clf=None, show=False, delay=0, dur=1, autoenc=True, returntrials=False, svdmap=0.0):
+def _null_rng(seed, i):
+    """
+    Utility function
+    Random state of null model i, independent of how null models are split across workers
+    """
+    return np.random.RandomState([seed, i])
+
+_null_state = {} # masked dataset and arguments of run_null_models, inherited (not pickled) by forked workers
+
+def _null_accuracies(span):
+    """
+    Utility function
+    Accuracies of null models span=(start, stop), run in run_null_models worker processes
+    """
+    st = _null_state
+    acc = []
+    for i in range(*span):
+        n=do_subj_classification(st['ds'], st['subj'], st['task'], st['cond'], null_model=True, rngs=[_null_rng(st['seed'], i)], **st['kwargs'])
+        acc.append((n['res'][0]==n['res'][1]).mean())
+    return acc
+
+def run_null_models(ds_masked, subj, task, cond, n_null=N_NULL, start=0, n_jobs=N_JOBS, seed=NULL_SEED, **kwargs):
+    """
+    Null-model executor: accuracies of null models start, ..., start+n_null-1
+    Null model i uses random state _null_rng(seed, i), so results are identical for any n_jobs
+    Null models are spread over a pool of n_jobs forked worker processes,
+    which share ds_masked read-only (copy-on-write) instead of receiving a pickled copy
+
+    inputs:
+     ds_masked - a masked dataset for subject
+          subj - subject  - sid00[0-9]{4}    
+          task - choose the clf task
+          cond - choose the condition h/i
+        n_null - how many null models to run [N_NULL]
+         start - index of the first null model [0]
+        n_jobs - number of worker processes [N_JOBS]
+          seed - null model seed [NULL_SEED]
+        kwargs - do_subj_classification options: clf, delay, dur, svdmap, backend, encoded
+
+    outputs:
+          null - null model accuracies (n_null,)
+    """
+    global _null_state
+    stop = start + n_null
+    if kwargs.get('backend') == 'ridge' and 'stim-enc' not in task: # one pass, in-process
+        r=do_subj_classification(ds_masked, subj, task, cond, null_model=False, n_null=n_null, rngs=[_null_rng(seed, i) for i in range(start, stop)], **kwargs)
+        return (r['null']==r['res'][0]).mean(1) if n_null else np.zeros(0)
+    _null_state = {'ds':ds_masked, 'subj':subj, 'task':task, 'cond':cond, 'seed':seed, 'kwargs':kwargs}
+    try:
+        if n_jobs <= 1 or n_null < 2:
+            null = _null_accuracies((start, stop))
+        else:
+            bounds = np.linspace(start, stop, min(n_null, 4*n_jobs)+1).astype(int) # a few spans per worker for load balance
+            pool = multiprocessing.Pool(n_jobs) # forked after _null_state is set
+            try:
+                null = sum(pool.map(_null_accuracies, zip(bounds[:-1], bounds[1:]), chunksize=1), [])
+            finally:
+                pool.close()
+                pool.join()
+    finally:
+        _null_state = {}
+    return np.array(null)
+
+def run_adaptive_null_models(ds_masked, subj, task, cond, acc, n_null=N_NULL, h=NULL_H, block=NULL_BLOCK, **kwargs):
+    """
+    Sequential (Besag-Clifford) null models: run null models 0, 1, 2, ... in blocks of increasing size
+    and stop at the null model where the h-th null accuracy >= acc occurs, or after n_null null models
+    The result does not depend on block size or n_jobs, as it is truncated at the stopping null model
+    The truncated sample's mean is biased by the stopping rule, so the first block is also returned
+    untruncated: a fixed-size null sample for the null mean (mn0)
+
+    inputs:
+     ds_masked, subj, task, cond - as run_null_models
+           acc - true model accuracy
+        n_null - maximum number of null models [N_NULL]
+             h - number of exceedances to stop at [NULL_H]
+         block - size of the first block of null models [NULL_BLOCK]
+        kwargs - run_null_models options: n_jobs, seed, clf, delay, dur, svdmap, backend
+
+    outputs:
+          null - null model accuracies (number of null models used,)
+             p - sequential p-value, h / len(null) if stopped early, else (exceedances + 1) / (n_null + 1)
+         null0 - accuracies of the first min(block, n_null) null models, whether or not it stopped in them
+    """
+    null = np.zeros(0)
+    n0 = min(block, n_null)
+    while len(null) < n_null:
+        n = min(block, n_null - len(null))
+        null = np.r_[null, run_null_models(ds_masked, subj, task, cond, n, start=len(null), **kwargs)]
+        exceed = np.flatnonzero(null >= acc)
+        if len(exceed) >= h: # decided: p is not small
+            stop = exceed[h-1]+1
+            return null[:stop], h / float(stop), null[:n0]
+        block *= 2
+    return null, ((null >= acc).sum() + 1.0) / (n_null + 1.0), null[:n0]
+
+def do_masked_subject_classification(ds, subj, task, cond, rois=[1030,2030], n_null=N_NULL, clf=None, show=False, delay=0, dur=1, autoenc=True, returntrials=False, svdmap=0.0, backend='svm', n_jobs=N_JOBS, seed=NULL_SEED, returnnull=False, adaptive=False):
     """
     The top-level classification entry point.
     Apply mask and do_subj_classification.
@@ -631,26 +1541,46 @@ def do_masked_subject_classification(ds, subj, task, cond, rois=[1030,2030], n_n
        autoenc - whether to use autoencoded BOLD data [True]
     returntrials- whether to return individual trials [False]
        svdmap  - proportion of svd components to use for SVD Mapper [0.0]
+       backend - classifier backend from CLF_BACKENDS, 'ridge' scores all null models in one pass ['svm']
+        n_jobs - number of null model worker processes [N_JOBS]
+          seed - null model seed, see run_null_models [NULL_SEED]
+    returnnull - whether to return the per-permutation null accuracies [False]
+      adaptive - stop null models early once the p-value is decided, see run_adaptive_null_models [False]
 
     outputs:
-          [targets, predictions], [[null_targets1,null_predictions1], ...]
+          d - {'mn': accuracy, 'mn0': mean null accuracy, 'bl': chance, 'n_null': null models used, 'p': permutation p-value, 'adaptive': adaptive}
+              adaptive: 'n_null' and 'p' are from the stopped sequence, 'mn0' from its first NULL_BLOCK null models
     """
     if task not in tasks:
         raise ValueError("task %s not in tasks"%task)
     clf = P.LinearCSVMC() if clf is None else clf
-    if not autoenc: # use freesurfer parcellation
-        ds_masked = mask_subject_ds(ds, subj, rois)
-    else:                            # get autoencoded data
-        ds_masked = get_autoencoded_subject_ds(ds, subj, rois)
-    r=do_subj_classification(ds_masked, subj, task, cond, clf=clf, null_model=False, delay=delay, dur=dur, svdmap=svdmap)
+    with trace_stage('mask'):
+        if not autoenc: # use freesurfer parcellation
+            ds_masked = mask_subject_ds(ds, subj, rois)
+        else:                            # get autoencoded data
+            ds_masked = get_autoencoded_subject_ds(ds, subj, rois)
+    with trace_stage('encode'): # once, shared by the true and all null models
+        ds_masked = _encode_task_condition_targets(ds_masked, subj, task, cond, delay, dur)
+    batch = backend=='ridge' and not adaptive # ridge scores all null models with the true model
+    with trace_stage('classify', n_null=n_null if batch else 0):
+        r=do_subj_classification(ds_masked, subj, task, cond, clf=clf, null_model=False, delay=delay, dur=dur, svdmap=svdmap, backend=backend, n_null=n_null if batch else 0, rngs=[_null_rng(seed, i) for i in range(n_null)] if batch else None, encoded=True)
     res=(r['res'][0]==r['res'][1]).mean()
-    null=[]
-    for _ in range(n_null):
-        n=do_subj_classification(ds_masked, subj, task, cond, clf=clf, null_model=True, delay=delay, dur=dur, svdmap=svdmap)
-        null.append((n['res'][0]==n['res'][1]).mean())
-    d = {'mn':res, 'mn0':np.array(null).mean(), 'bl': 1.0 / len(np.unique(r['res'][0]))}
+    with trace_stage('null', n_jobs=n_jobs):
+        if 'null' in r: # ridge backend, null models were scored with the true model
+            null=(r['null']==r['res'][0]).mean(1)
+        elif adaptive:
+            null, p, null0=run_adaptive_null_models(ds_masked, subj, task, cond, res, n_null, n_jobs=n_jobs, seed=seed, clf=clf, delay=delay, dur=dur, svdmap=svdmap, backend=backend, encoded=True)
+        else:
+            null=run_null_models(ds_masked, subj, task, cond, n_null, n_jobs=n_jobs, seed=seed, clf=clf, delay=delay, dur=dur, svdmap=svdmap, backend=backend, encoded=True)
+    null = np.array(null)
+    if not adaptive:
+        p = ((null >= res).sum() + 1.0) / (len(null) + 1.0)
+        null0 = null # adaptive runs return null0, a fixed-size first block unbiased by the stopping rule
+    d = {'mn':res, 'mn0':np.mean(null0), 'bl': 1.0 / len(np.unique(r['res'][0])), 'n_null':len(null), 'p':p, 'adaptive':bool(adaptive)}
     if returntrials: # return individual trials, if requested
         d.update({'target': r['res'][0], 'pred': r['res'][1], 'tp':(r['res'][0]==r['res'][1])})
+    if returnnull: # return per-permutation null accuracies, if requested
+        d['null'] = null
     return d
 
 def get_result_stats(res, show=True):
@@ -867,7 +1797,44 @@ def count_sub_sig_res(subj_res):
                         s['wx']/=s['mn']
     return sig_res
 
-def calc_group_results(subj_res, null_model=True, bilateral=False):
+def _calc_group_results_vec(subj_res, cells, null_model=True):
+    """
+    Utility function
+    Group results for all (task, roi, hemi, cond) cells at once: accuracies are stacked
+    into (subject x cell) arrays and all tests and summary statistics are column-wise,
+    giving the same results as ttest_result_null / ttest_result_baseline per cell
+
+    inputs:
+          subj_res - per-subject results dict
+             cells - list of (task, roi, hemi, cond), hemi in {'LH', 'RH'}, no stim-enc tasks
+        null_model - whether to use null model, else use baseline model [True]
+    outputs:
+         cell_res - list of result dicts, one per cell
+    """
+    subjs = list(subj_res.keys())
+    stack = lambda key: np.array([[subj_res[subj][task][roi][hemi][cond][key] for task, roi, hemi, cond in cells] for subj in subjs], dtype='float64').reshape(len(subjs), len(cells))
+    a = stack('mn')
+    bl = stack('bl')[-1] # baseline of the last subject, as ttest_result_*
+    n = float(len(a))
+    if null_model:
+        b = stack('mn0')
+        ttest_name = [k for k in _TTESTS if _TTESTS[k] is TTEST]
+        if ttest_name and ttest_name[0] in _TTESTS_VEC:
+            tt = _TTESTS_VEC[ttest_name[0]](a, b)
+            tt = list(zip(tt[0], tt[1]))
+        else: # no column-wise version of TTEST
+            tt = [TTEST(a[:,j], b[:,j]) for j in range(len(cells))]
+        wx = list(zip(*_wilcoxon(a - b)))
+        bm, be = b.mean(0), b.std(0) / np.sqrt(n)
+    else:
+        tt = P.ttest_1samp(a, bl, axis=0, alternative='greater') # pymvpa's ttest_1samp
+        tt = list(zip(tt[0], tt[1]))
+        wx = list(zip(*_wilcoxon(a - bl)))
+        bm, be = np.zeros(len(cells)), np.zeros(len(cells))
+    am, ae, amin, amax = a.mean(0), a.std(0) / np.sqrt(n), a.min(0), a.max(0)
+    return [{'tt':tt[j], 'wx':wx[j], 'mn':am[j], 'min':amin[j], 'max':amax[j], 'se':ae[j], 'mn0':bm[j], 'se0':be[j], 'bl': bl[j]} for j in range(len(cells))]
+
+def calc_group_results(subj_res, null_model=True, bilateral=False, vectorized=True):
     """
     Calculate all-subject group results for tasks, rois, hemis, and conds
     Ttest and wilcoxon made relative to baseline of task
@@ -876,14 +1843,16 @@ def calc_group_results(subj_res, null_model=True, bilateral=False):
           subj_res - per-subject raw results (targets, predictions) per task,roi,hemi, and cond
         null_model - whether to use null model, else use baseline model [True]
          bilateral - whether the result dataset is bilateral {LH -> LH+RH only} [False]
+        vectorized - compute all classification cells at once, see _calc_group_results_vec [True]
     outputs:
        group_res - group-level ttest / wilcoxon results over within-subject means
     """
     group_res = {}
-    subjects=subj_res.keys()
+    subjects=list(subj_res.keys())
     if len(subjects)<2:
         print "Warning: *** Too Few Subjects for Group Analysis, Performing Anyway.... ****"
     hemi_l = [0] if bilateral else [0, 1000]
+    cells = []
     for task in subj_res[subjects[0]].keys():
         group_res[task]={}
         for roi in subj_res[subjects[0]][task].keys():
@@ -893,10 +1862,170 @@ def calc_group_results(subj_res, null_model=True, bilateral=False):
                 group_res[task][roi][hemiL]={}
                 for cond in ['h','i']:
                     #print task, roi_map[roi+hemi].replace('ctx-',''), cond.upper(),
-                    if null_model:
+                    if vectorized and 'stim-enc' not in task:
+                        cells.append((task, roi, hemiL, cond))
+                    elif null_model:
                         group_res[task][roi][hemiL][cond] = ttest_result_null(subj_res, task, roi, hemi, cond)
                     else:
                         group_res[task][roi][hemiL][cond] = ttest_result_baseline(subj_res, task, roi, hemi, cond)
+    if cells:
+        for (task, roi, hemiL, cond), r in zip(cells, _calc_group_results_vec(subj_res, cells, null_model)):
+            group_res[task][roi][hemiL][cond] = r
+    return group_res
+
+def _new_group_cell():
+    """
+    Utility function
+    Empty sufficient statistics of a (task, roi, hemi, cond) group cell
+    """
+    return {'vals':{}, 'n':0, 's_a':0., 'ss_a':0., 's_b':0., 'ss_b':0., 's_d':0., 'ss_d':0.,
+            'a_sorted':[], 'd_sorted':[], 'bl':None, 'res':{}}
+
+def _fold_group_cell(cell, subj, r):
+    """
+    Utility function
+    Fold subject's result r into cell, replacing the subject's previous result if any
+    """
+    for sign, ab in [(-1, cell['vals'].get(subj)), (1, (r['mn'], r['mn0']))]:
+        if ab is None:
+            continue
+        a, b = ab
+        d = a - b
+        cell['n'] += sign
+        cell['s_a'] += sign*a; cell['ss_a'] += sign*a*a
+        cell['s_b'] += sign*b; cell['ss_b'] += sign*b*b
+        cell['s_d'] += sign*d; cell['ss_d'] += sign*d*d
+        if sign < 0:
+            cell['a_sorted'].pop(bisect.bisect_left(cell['a_sorted'], a))
+            cell['d_sorted'].pop(bisect.bisect_left(cell['d_sorted'], d))
+        else:
+            bisect.insort(cell['a_sorted'], a)
+            bisect.insort(cell['d_sorted'], d)
+    cell['vals'][subj] = (r['mn'], r['mn0'])
+    cell['bl'] = r['bl']
+    cell['res'] = {} # group statistics are stale
+
+def _ttest_key():
+    """
+    Utility function
+    Name of the current TTEST in _TTESTS, or its qualified function name
+    """
+    ttest_name = [k for k in _TTESTS if _TTESTS[k] is TTEST]
+    return ttest_name[0] if ttest_name else '%s.%s'%(getattr(TTEST, '__module__', ''), getattr(TTEST, '__name__', repr(TTEST)))
+
+def _restrict_group_cell(cell, subjs):
+    """
+    Utility function
+    Sufficient statistics of cell over the given subjects only
+    """
+    sub = _new_group_cell()
+    for subj in subjs:
+        if subj in cell['vals']:
+            a, b = cell['vals'][subj]
+            _fold_group_cell(sub, subj, {'mn':a, 'mn0':b, 'bl':cell['bl']})
+    return sub
+
+def _group_cell_result(cell, null_model=True):
+    """
+    Utility function
+    Group statistics of a cell from its sufficient statistics, as ttest_result_null / ttest_result_baseline
+    """
+    n = float(cell['n'])
+    ma, mb, bl = cell['s_a']/n, cell['s_b']/n, cell['bl']
+    va, vb = cell['ss_a']/n - ma*ma, cell['ss_b']/n - mb*mb # population variances
+    va, vb = max(va, 0.), max(vb, 0.)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if null_model:
+            ttest_name = _ttest_key()
+            if ttest_name == 'ind':
+                t = (ma - mb) / np.sqrt((va + vb) / (n - 1)) # pooled variance, equal sizes
+                tt = (t, 2*student_t.sf(np.abs(t), 2*n-2))
+            elif ttest_name == 'welch':
+                sa, sb = va/(n-1), vb/(n-1) # squared standard errors
+                t = (ma - mb) / np.sqrt(sa + sb)
+                tt = (t, 2*student_t.sf(np.abs(t), (sa + sb)**2 / ((sa*sa + sb*sb) / (n-1))))
+            elif ttest_name == 'rel':
+                md = cell['s_d']/n
+                t = md / np.sqrt(max(cell['ss_d']/n - md*md, 0.) / (n - 1))
+                tt = (t, 2*student_t.sf(np.abs(t), n-1))
+            elif ttest_name == 'wilcoxon':
+                tt = tuple(v[0] for v in _wilcoxon(cell['d_sorted']))
+            else: # no sufficient statistics for TTEST
+                subjs = sorted(cell['vals'].keys())
+                tt = TTEST(np.array([cell['vals'][k][0] for k in subjs]), np.array([cell['vals'][k][1] for k in subjs]))
+            wx = tuple(v[0] for v in _wilcoxon(cell['d_sorted']))
+            bm, be = mb, np.sqrt(vb / n)
+        else:
+            t = (ma - bl) / np.sqrt(va / (n - 1))
+            tt = (t, student_t.sf(t, n-1)) # one-sided, greater than baseline
+            wx = tuple(v[0] for v in _wilcoxon(np.array(cell['a_sorted']) - bl))
+            bm, be = 0.0, 0.0
+    return {'tt':tt, 'wx':wx, 'mn':ma, 'min':cell['a_sorted'][0], 'max':cell['a_sorted'][-1], 'se':np.sqrt(va / n), 'mn0':bm, 'se0':be, 'bl':bl}
+
+def update_group_results(resultdir=None, tsks=tasks, subjs=subjects, null_model=True):
+    """
+    Incremental calc_group_results for a result directory that is still being written
+    Per-cell sufficient statistics are cached next to the result directory (resultdir_group_cache.pickle),
+    only (subj,task) parts that are new or changed since the last call are loaded and folded in,
+    and group statistics are only recomputed for cells that changed
+    Cached group statistics are kept per (null_model, TTEST, subjs), cells only hold
+    the subjects in subjs when computing them
+    Subjects whose parts have not landed yet are left out of the group statistics
+
+    inputs:
+     resultdir - directory for results [RESULTDIR]
+          tsks - list of tasks, stim-enc tasks are skipped [tasks]
+         subjs - list of subjects [subjects]
+    null_model - whether to use null model, else use baseline model [True]
+    outputs:
+       group_res - group-level ttest / wilcoxon results over within-subject means
+    """
+    resultdir = RESULTDIR if resultdir is None else resultdir
+    cache_file = resultdir.rstrip(os.sep) + '_group_cache.pickle'
+    state = None
+    if os.path.exists(cache_file):
+        try:
+            with open(cache_file, 'rb') as f:
+                state = pickle.load(f)
+        except Exception:
+            state = None
+    state = {'parts':{}, 'cells':{}} if state is None else state
+    changed = False
+    for subj in subjs:
+        for task in tsks:
+            if 'stim-enc' in task:
+                continue
+            fname = _result_store_segment(resultdir, subj, task)
+            fname = fname if os.path.exists(fname) else opj(resultdir, "%s_%s_res_part.pickle"%(subj,task))
+            if not os.path.exists(fname):
+                continue # not landed yet
+            st = os.stat(fname)
+            if state['parts'].get((subj, task)) == (st.st_mtime, st.st_size):
+                continue
+            part = _load_subj_task_part(resultdir, subj, task)[task]
+            for roi in part:
+                for hemi in part[roi]:
+                    for cond in part[roi][hemi]:
+                        _fold_group_cell(state['cells'].setdefault((task, roi, hemi, cond), _new_group_cell()), subj, part[roi][hemi][cond])
+            state['parts'][(subj, task)] = (st.st_mtime, st.st_size)
+            changed = True
+    group_res = {}
+    subjs_key = frozenset(subjs)
+    key = (null_model, _ttest_key(), subjs_key)
+    for (task, roi, hemi, cond), cell in state['cells'].items():
+        if task not in tsks:
+            continue
+        if key not in cell['res']:
+            sub = cell if subjs_key.issuperset(cell['vals']) else _restrict_group_cell(cell, subjs)
+            cell['res'][key] = _group_cell_result(sub, null_model) if sub['n'] else None
+            changed = True
+        if cell['res'][key] is not None:
+            group_res.setdefault(task, {}).setdefault(roi, {}).setdefault(hemi, {})[cond] = cell['res'][key]
+    if changed:
+        try:
+            _atomic_write(cache_file, lambda f: pickle.dump(state, f, pickle.HIGHEST_PROTOCOL))
+        except (IOError, OSError):
+            print("Warning: cannot write group cache %s"%cache_file)
     return group_res
 
 def _get_stars(mn,bl,p, stim_enc=False):
@@ -1007,28 +2136,267 @@ def save_result_subj_task(res, subject, task, resultdir=None):
     """
     resultdir = RESULTDIR if resultdir is None else resultdir
     fname = "%s_%s_res_part.pickle"
-    with open(opj(resultdir, fname%(subject,task)), "w") as f:
-        pickle.dump(res, f)
+    _atomic_write(opj(resultdir, fname%(subject,task)), lambda f: pickle.dump(res, f), mode="w")
+
+def _checkpoint_dir(resultdir, subject, task):
+    """
+    Utility function
+    Directory of a (subject, task) job's per-cell checkpoints
+    """
+    return opj(resultdir, "%s_%s_ckpt"%(subject, task))
+
+def checkpoint_cell_file(subject, task, roi, hemi, cond, resultdir=None):
+    """
+    Checkpoint file of one (roi, hemi, cond) cell of a (subject, task) job
+    """
+    resultdir = RESULTDIR if resultdir is None else resultdir
+    return opj(_checkpoint_dir(resultdir, subject, task), "%d_%s_%s.pickle"%(roi, hemi, cond))
+
+def save_checkpoint_cell(r, subject, task, roi, hemi, cond, resultdir=None):
+    """
+    Atomically checkpoint one (roi, hemi, cond) result of a (subject, task) job
+
+    inputs:
+          r - result of do_masked_subject_classification
+    subject - subject id - sid00[0-9]{4}
+       task - name of task from tasks
+        roi - LH roi key
+       hemi - 'LH' or 'RH'
+       cond - 'h' or 'i'
+  resultdir - directory for results [RESULTDIR]
+    """
+    resultdir = RESULTDIR if resultdir is None else resultdir
+    ckpt = _checkpoint_dir(resultdir, subject, task)
+    if not os.path.exists(ckpt):
+        try:
+            os.mkdir(ckpt)
+        except OSError: # created by a concurrent writer
+            pass
+    _atomic_write(checkpoint_cell_file(subject, task, roi, hemi, cond, resultdir), lambda f: pickle.dump(r, f, pickle.HIGHEST_PROTOCOL))
+
+def load_checkpoint(subject, task, resultdir=None):
+    """
+    Load the checkpointed cells of an unfinished (subject, task) job
+    Unreadable (e.g. truncated) cell files are removed, so the cells are recomputed
+
+    outputs:
+        cells - {roi: {hemi: {cond: result}}}, empty if there are no checkpoints
+          bad - list of (roi, hemi, cond) whose checkpoint was unreadable
+    """
+    resultdir = RESULTDIR if resultdir is None else resultdir
+    cells, bad = {}, []
+    for fname in glob.glob(opj(_checkpoint_dir(resultdir, subject, task), "*_*_*.pickle")):
+        roi, hemi, cond = spl(fname)[1][:-len(".pickle")].split('_')
+        try:
+            with open(fname, "rb") as f:
+                r = pickle.load(f)
+        except Exception:
+            print("Warning: unreadable checkpoint %s, recomputing"%fname)
+            bad.append((int(roi), hemi, cond))
+            try:
+                os.remove(fname)
+            except OSError:
+                pass
+            continue
+        cells.setdefault(int(roi), {}).setdefault(hemi, {})[cond] = r
+    return cells, bad
+
+def remove_checkpoint(subject, task, resultdir=None):
+    """
+    Remove a (subject, task) job's checkpoints, once its result part is saved
+    """
+    resultdir = RESULTDIR if resultdir is None else resultdir
+    shutil.rmtree(_checkpoint_dir(resultdir, subject, task), ignore_errors=True)
+
+_RESULT_COLUMNS = ['subj','task','roi','hemi','cond','delay','dur','n_null','autoenc','svdmap','adaptive','mn','mn0','bl','p']
+_RESULT_ARRAYS = ['target','pred','null'] # optional per-trial and per-permutation arrays, flat with row offsets
+
+def _result_store_segment(resultdir, subject, task):
+    """
+    Utility function
+    Result store segment file of a (subject, task) job
+    """
+    return opj(resultdir, RESULTSTORE, '%s_%s.npz'%(subject, task))
+
+def save_result_store(res, subject, task, delay=0, dur=1, n_null=N_NULL, autoenc=0, svdmap=0.0, resultdir=None, adaptive=0):
+    """
+    Save (subj,task) results as a segment of the columnar result store in resultdir/RESULTSTORE
+    One row per (roi, hemi, cond) with fixed-dtype columns _RESULT_COLUMNS,
+    plus flat _RESULT_ARRAYS columns with '<name>_offsets' row offsets when results have them
+    Each job writes its own segment atomically, so concurrent jobs append without locking
+    
+    inputs:
+        res  - results of the __main__ roi loop, res[subject][task][roi][hemi][cond]
+     subject - subject id - sid00[0-9]{4}
+      task   - name of task from tasks
+      delay, dur, n_null, autoenc, svdmap - model parameters, as set_resultdir_by_params
+   resultdir - directory for results [RESULTDIR]
+    adaptive - whether null models were stopped early, for results without an 'adaptive' entry [0]
+
+    outputs:
+        saves file in resultdir/RESULTSTORE "%s_%s.npz"%(subject,task)
+    """
+    resultdir = RESULTDIR if resultdir is None else resultdir
+    rows = []
+    for roi in sorted(res[subject][task].keys()):
+        for hemi in sorted(res[subject][task][roi].keys()):
+            for cond in sorted(res[subject][task][roi][hemi].keys()):
+                rows.append((roi, hemi, cond, res[subject][task][roi][hemi][cond]))
+    n = len(rows)
+    cols = {'subj': np.array([subject]*n, dtype='S'),
+            'task': np.array([task]*n, dtype='S'),
+            'roi': np.array([row[0] for row in rows], dtype='int32'),
+            'hemi': np.array([row[1] for row in rows], dtype='S'),
+            'cond': np.array([row[2] for row in rows], dtype='S'),
+            'delay': np.ones(n, dtype='int32')*delay,
+            'dur': np.ones(n, dtype='int32')*dur,
+            'n_null': np.array([row[3].get('n_null', n_null) for row in rows], dtype='int32'),
+            'autoenc': np.ones(n, dtype='int32')*autoenc,
+            'svdmap': np.ones(n, dtype='float64')*svdmap,
+            'adaptive': np.array([row[3].get('adaptive', adaptive) for row in rows], dtype='int32')}
+    for col in ['mn','mn0','bl']:
+        cols[col] = np.array([row[3][col] for row in rows], dtype='float64')
+    cols['p'] = np.array([row[3].get('p', np.nan) for row in rows], dtype='float64')
+    for col in _RESULT_ARRAYS:
+        if any(col in row[3] for row in rows):
+            dtype = np.result_type(*[np.asarray(row[3][col]) for row in rows if col in row[3]])
+            arrays = [np.asarray(row[3][col] if col in row[3] else [], dtype=dtype).reshape(-1) for row in rows]
+            cols[col] = np.hstack(arrays)
+            cols[col+'_offsets'] = np.r_[0, np.cumsum([len(a) for a in arrays])].astype('int64')
+    fname = _result_store_segment(resultdir, subject, task)
+    if not os.path.isdir(os.path.dirname(fname)):
+        try:
+            os.makedirs(os.path.dirname(fname))
+        except OSError: # created by a concurrent job
+            pass
+    _atomic_write(fname, lambda f: np.savez(f, **cols))
+
+def load_result_store(resultdir=None, subjs=None, tsks=None, columns=None):
+    """
+    Load rows of the columnar result store, only reading the segments and columns asked for
+    
+    inputs: 
+  resultdir - directory for results [RESULTDIR]
+      subjs - list of subjects [None: all]
+       tsks - list of tasks [None: all]
+    columns - list of columns from _RESULT_COLUMNS + _RESULT_ARRAYS [None: all]
+    outputs:
+       table - {column: array (one entry per row)}, _RESULT_ARRAYS columns are object arrays
+               of per-row arrays (None where a row has no such array)
+    """
+    resultdir = RESULTDIR if resultdir is None else resultdir
+    table = {}
+    for fname in sorted(glob.glob(opj(resultdir, RESULTSTORE, '*.npz'))):
+        subj, task = spl(fname)[1][:-len('.npz')].split('_', 1)
+        if (subjs is not None and subj not in subjs) or (tsks is not None and task not in tsks):
+            continue
+        with np.load(fname) as z: # columns are read lazily
+            n = len(z['roi'])
+            for col in (_RESULT_COLUMNS + _RESULT_ARRAYS if columns is None else columns):
+                if col in _RESULT_ARRAYS:
+                    if col in z.files:
+                        flat, offsets = z[col], z[col+'_offsets']
+                        table.setdefault(col, []).extend([flat[offsets[i]:offsets[i+1]] if offsets[i+1]>offsets[i] else None for i in range(n)])
+                    else:
+                        table.setdefault(col, []).extend([None]*n)
+                elif col not in z.files: # column added after the segment was written
+                    table.setdefault(col, []).append(np.ones(n)*np.nan)
+                else:
+                    a = z[col]
+                    table.setdefault(col, []).append(a.astype(str) if a.dtype.kind=='S' else a)
+    for col in table.keys():
+        if col in _RESULT_ARRAYS:
+            arrays = np.empty(len(table[col]), dtype=object)
+            arrays[:] = table[col]
+            table[col] = arrays
+        else:
+            table[col] = np.hstack(table[col])
+    return table
+
+def result_store_to_subj_res(table):
+    """
+    Convert result store rows to a per-subject results dict, subj_res[subj][task][roi][hemi][cond]
+    """
+    subj_res = {}
+    for i in range(len(table['roi'])):
+        r = {'mn':table['mn'][i], 'mn0':table['mn0'][i], 'bl':table['bl'][i]}
+        if 'n_null' in table:
+            r['n_null'] = int(table['n_null'][i])
+        if 'p' in table and not np.isnan(table['p'][i]):
+            r['p'] = table['p'][i]
+        if 'adaptive' in table and not np.isnan(table['adaptive'][i]):
+            r['adaptive'] = bool(table['adaptive'][i])
+        if table.get('target') is not None and table['target'][i] is not None:
+            r.update({'target':table['target'][i], 'pred':table['pred'][i], 'tp':table['target'][i]==table['pred'][i]})
+        if table.get('null') is not None and table['null'][i] is not None:
+            r['null'] = table['null'][i]
+        subj_res.setdefault(table['subj'][i], {}).setdefault(table['task'][i], {}).setdefault(int(table['roi'][i]), {}).setdefault(table['hemi'][i], {})[table['cond'][i]] = r
+    return subj_res
+
+def _load_subj_task_part(resultdir, subj, task):
+    """
+    Utility function
+    Load one (subj,task) result part: {task: res[roi][hemi][cond]}
+    from the result store segment if present, else from the pickled part
+    """
+    if os.path.exists(_result_store_segment(resultdir, subj, task)):
+        cols = _RESULT_COLUMNS + ['target', 'pred']
+        return result_store_to_subj_res(load_result_store(resultdir, [subj], [task], cols)).get(subj, {})
+    fname = "%s_%s_res_part.pickle"
+    with open(opj(resultdir, fname%(subj,task)), "rb") as f:
+        res_part = pickle.loads(f.read()) # one read, releases the GIL during I/O
+    return res_part[subj]
 
-def load_all_subj_res_from_parts(tsks=tasks, subjs=subjects, resultdir=None):
+class _LazySubjRes(Mapping):
+    """
+    Utility class
+    A subject's {task: results} mapping that loads each (subj,task) part on first access
+    """
+    def __init__(self, resultdir, subj, tsks):
+        self._resultdir = resultdir
+        self._subj = subj
+        self._tsks = list(tsks)
+        self._parts = {}
+
+    def __getitem__(self, task):
+        if task not in self._tsks:
+            raise KeyError(task)
+        if task not in self._parts:
+            self._parts[task] = _load_subj_task_part(self._resultdir, self._subj, task)[task]
+        return self._parts[task]
+
+    def __iter__(self):
+        return iter(self._tsks)
+
+    def __len__(self):
+        return len(self._tsks)
+
+def load_all_subj_res_from_parts(tsks=tasks, subjs=subjects, resultdir=None, n_jobs=IO_JOBS, lazy=False):
     """
     Load all partial result files and concatenate into a single dict
     
     inputs: 
        tsks - list of tasks [tasks]
       subjs - list of subjects [subjects]
+  resultdir - directory for results [RESULTDIR]
+     n_jobs - number of parts read concurrently [IO_JOBS]
+       lazy - load each (subj,task) part on first access of subj_res[subj][task] [False]
     outputs:
        subj_res - per-subject results dict, indexed by sid00[0-9]{4}
     """
     resultdir = RESULTDIR if resultdir is None else resultdir
-    subj_res={}
-    for subj in subjs:
-        subj_res[subj]={}
-        for task in tsks:
-            fname = "%s_%s_res_part.pickle"
-            with open(opj(resultdir, fname%(subj,task)), "r") as f:
-                res_part = pickle.load(f)
-                subj_res[subj].update(res_part[subj])
+    if lazy:
+        return dict((subj, _LazySubjRes(resultdir, subj, tsks)) for subj in subjs)
+    parts = [(subj, task) for subj in subjs for task in tsks]
+    pool = ThreadPool(max(1, min(n_jobs, len(parts))))
+    try:
+        res_parts = pool.map(lambda part: _load_subj_task_part(resultdir, *part), parts, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    subj_res=dict((subj, {}) for subj in subjs)
+    for (subj, task), res_part in zip(parts, res_parts):
+        subj_res[subj].update(res_part)
     return subj_res
 
 # def export_res_csv(subj_res=None, subj_tt=None, group_tt=None, integrity_check=True):
@@ -1122,112 +2490,121 @@ def export_res_csv(task, csv_filename, rois=[1001, 1012, 1019, 1024, 1030, 1031,
         5 - Cycle
         0 - TR (either 0 or 1 i.e. which section of the 4s stimuli representation it is)
         R - Right hemisphere        
+
+    Each subject is loaded and classified once, rows are written as they are read from csv_filename
+    to a temporary file, renamed to the output file once all rows are checked
+    returns the name of the written csv file
 """
-    f = open(csv_filename,'r') 
-    reader = csv.reader(f)
     autoencstr = 'autoenc' if autoenc else 'rawbold'
-    fnew = open(csv_filename.replace('.csv','_%s_%s.csv'%(task,autoencstr)),'w') # append filename with task
-    writer = csv.writer(fnew)
-    db = [row for row in reader]
-    Trial_ID_idx = db[0].index('Trial_ID')
-    Trial_ID_Check_idx = db[0].index('Trial_ID_Check')
-    #Subj_ID_idx = db[0].index('Subj_ID')
-    R_Hemi_idx = db[0].index('R_Hemi')
-    Trumpet_idx = db[0].index('Trumpet')
-    Trial_Target_idx = db[0].index('Trial_Target')
-    Heard_idx = db[0].index('Heard')
-    res = {}
-    db_new = []
+    out_filename = csv_filename.replace('.csv','_%s_%s.csv'%(task,autoencstr)) # append filename with task
     rois_lat = np.unique(np.r_[np.array(rois), np.array(rois)+1000]) # complete lateral rois
-    current = 0
-    db_new.append(list(db[current])) # make a copy of the current row
-    roi_labels = []
-    for roi in rois:
-        roi_labels.append('%d_%s_Correct'%(roi,task.replace('-','_')))
-    db_new[-1].extend(roi_labels)
-    for hemi in [1,0]:
-        for TR in [0,1]: # two TRs per target
-            for subj in subjects: # subjects are organized in accesssion order
-                res={}
-                print subj, "loading ds....",
-                sys.stdout.flush()
-                ds = get_subject_ds(subj)
-                print "ds_task_cond_rois_clf",
-                sys.stdout.flush()
-                for cond in ['h','i']:
-                    res[cond] = do_ds_task_cond_rois_clf(ds, task=task, cond=cond, rois=rois_lat, delay=delay, dur=dur, autoenc=autoenc)
-                print "T/F res[subj][task][roi][cond]..."
-                sys.stdout.flush()
-                t = {'h':{},'i':{}}
-                targets = {}
-                ds_masked = mask_subject_ds(ds, subj, rois[0]) # targets for all ROIs are the same
-                for cond in ['h','i']:
-                    targets[cond] = _encode_task_condition_targets(ds_masked, subj, task, cond, delay=delay, dur=dur).targets
-                    if 'X' in task: # undo preservation of 'h' and 'i' if cross-decoding, make condition-specific targets
-                        if cond=='h':
-                            targets[cond] = targets[cond].reshape(8,-1)[np.array([0,1,4,5]),:].reshape(-1)
-                        elif cond=='i':
-                            targets[cond] = targets[cond].reshape(8,-1)[np.array([2,3,6,7]),:].reshape(-1)
-                for roi in rois:
-                    ds_masked = mask_subject_ds(ds, subj, roi)
-                    for cond in ['h','i']:
-                        t[cond][roi] = res[cond][subj][task][roi][cond]['pred']==targets[cond] # trial-by-trial T/F 
-                        t[cond][roi+1000] = res[cond][subj][task][roi+1000][cond]['pred']==targets[cond] # trial-by-trial T/F 
-                tt = np.arange(len(t['h'][rois[-1]])/4) # sequence contains 4 runs of TRs per cond
-                lenT = len(tt)
-                conds = ['h','h','i','i','h','h','i','i']
-                runs = [0,1,0,1,2,3,2,3] if legend[accessions[subj]][0] == 'HT' else [1,0,1,0,3,2,3,2] # pair-wise swap if 'HC'-first
-                for run_idx, run in enumerate(runs):
-                    for j in tt[TR::2]: # only 4 runs in a test HTHC+HTHC
-                        current += 1
-                        Trial_ID_Check = subj.replace('sid00','')+'.%d'%run_idx+'.%d'%(j/2)
-                        Trial_ID = subj.replace('sid00','')+'.%d'%run_idx+'.%d'%(j/2)+'.%d'%(j%2)+'.%s'%('LR'[hemi])
-                        db_new.append(list(db[current])) # make a copy of the current row
-                        assert db_new[-1][Trial_ID_Check_idx] == Trial_ID_Check # check Trial_ID except .[LR]
-                        assert int(db_new[-1][Trumpet_idx]) == int(legend[accessions[subj]][run_idx][1]=='T') # check Trumpet indicator
-                        assert int(db_new[-1][Heard_idx]) == int(conds[run_idx]=='h') # condition indicator
-                        assert int(db_new[-1][Trial_Target_idx]) == targets[conds[run_idx]][run*lenT+j] # pairwise-run swap targets via 'run'                        
-                        assert db_new[-1][Trial_ID_idx] == Trial_ID
-                        db_new[-1][R_Hemi_idx] = hemi
-                        print Trial_ID,
-                        sys.stdout.flush()
-                        trial_res = []
-                        for roi in np.array(rois)+1000*hemi:
-                            # pairwise-run swap result via 'run'
-                            trial_res.append(int(t[conds[run_idx]][roi][run*lenT+j]))
-                            print '%d,'%trial_res[-1], 
-                            sys.stdout.flush()
-                        db_new[-1].extend(trial_res) # append roi results
-                        print
-    f.close()
-    writer.writerows(db_new)
-    fnew.close()
-    return db_new
+    t = {} # trial-by-trial T/F, t[subj][cond][roi]
+    targets = {}
+    for subj in subjects: # each subject is loaded and classified once
+        print subj, "loading ds....",
+        sys.stdout.flush()
+        ds = get_subject_ds(subj)
+        print "ds_task_cond_rois_clf",
+        sys.stdout.flush()
+        t[subj] = {'h':{},'i':{}}
+        targets[subj] = {}
+        for cond in ['h','i']:
+            res = do_ds_task_cond_rois_clf(ds, task=task, cond=cond, rois=rois_lat, delay=delay, dur=dur, autoenc=autoenc)
+            tgts = _encode_task_condition_targets(ds[:, :1], subj, task, cond, delay=delay, dur=dur).targets # targets for all ROIs are the same
+            if 'X' in task: # undo preservation of 'h' and 'i' if cross-decoding, make condition-specific targets
+                if cond=='h':
+                    tgts = tgts.reshape(8,-1)[np.array([0,1,4,5]),:].reshape(-1)
+                elif cond=='i':
+                    tgts = tgts.reshape(8,-1)[np.array([2,3,6,7]),:].reshape(-1)
+            targets[subj][cond] = tgts
+            for roi in rois_lat:
+                t[subj][cond][roi] = res[subj][task][roi][cond]['pred']==tgts # trial-by-trial T/F 
+        del ds, res
+    conds = ['h','h','i','i','h','h','i','i']
+    def write_rows(fnew):
+        with open(csv_filename,'r') as f:
+            reader = csv.reader(f)
+            writer = csv.writer(fnew)
+            header = next(reader)
+            Trial_ID_idx = header.index('Trial_ID')
+            Trial_ID_Check_idx = header.index('Trial_ID_Check')
+            #Subj_ID_idx = header.index('Subj_ID')
+            R_Hemi_idx = header.index('R_Hemi')
+            Trumpet_idx = header.index('Trumpet')
+            Trial_Target_idx = header.index('Trial_Target')
+            Heard_idx = header.index('Heard')
+            writer.writerow(header + ['%d_%s_Correct'%(roi,task.replace('-','_')) for roi in rois])
+            for hemi in [1,0]:
+                for TR in [0,1]: # two TRs per target
+                    for subj in subjects: # subjects are organized in accesssion order
+                        tt = np.arange(len(t[subj]['h'][rois[-1]])/4) # sequence contains 4 runs of TRs per cond
+                        lenT = len(tt)
+                        runs = [0,1,0,1,2,3,2,3] if legend[accessions[subj]][0] == 'HT' else [1,0,1,0,3,2,3,2] # pair-wise swap if 'HC'-first
+                        for run_idx, run in enumerate(runs):
+                            for j in tt[TR::2]: # only 4 runs in a test HTHC+HTHC
+                                Trial_ID_Check = subj.replace('sid00','')+'.%d'%run_idx+'.%d'%(j/2)
+                                Trial_ID = subj.replace('sid00','')+'.%d'%run_idx+'.%d'%(j/2)+'.%d'%(j%2)+'.%s'%('LR'[hemi])
+                                row = next(reader) # the current row
+                                assert row[Trial_ID_Check_idx] == Trial_ID_Check # check Trial_ID except .[LR]
+                                assert int(row[Trumpet_idx]) == int(legend[accessions[subj]][run_idx][1]=='T') # check Trumpet indicator
+                                assert int(row[Heard_idx]) == int(conds[run_idx]=='h') # condition indicator
+                                assert int(row[Trial_Target_idx]) == targets[subj][conds[run_idx]][run*lenT+j] # pairwise-run swap targets via 'run'
+                                assert row[Trial_ID_idx] == Trial_ID
+                                row[R_Hemi_idx] = hemi
+                                # pairwise-run swap result via 'run', append roi results
+                                writer.writerow(row + [int(t[subj][conds[run_idx]][roi][run*lenT+j]) for roi in np.array(rois)+1000*hemi])
+    _atomic_write(out_filename, write_rows, mode='w') # a failed row check leaves no partial csv
+    return out_filename
 
 def export_res_nifti(grp_res, task='pch-class', cond='h', measure='mn', ref_subj=subjects[0]):
     """
-    Export group results as nifti file
-    """
-    fname = opj(DATADIR, 'sub-%s'%ref_subj, 'func', 'sub-%s_task-*_run-%02d_space-%s_%s.nii.gz'%(ref_subj,1,MRISPACE, PARCELLATION))
-    ds= P.fmri_dataset(glob.glob(fname)[0]) # refence subject T2w MRISPACE PARCELLATION, could be done with T1w image?
-    ds_res = ds.copy(deep=True)
-    ds_res.samples[:]=0
-    for roi in grp_res[task]:
-        for h, hemi in enumerate(['LH','RH']):
-            if cond=='i-h':
-                value = int( 1000 * ( grp_res[task][roi][hemi]['i'][measure] - grp_res[task][roi][hemi]['h'][measure] ) )
-            elif cond=='h-i':
-                value = int( 1000 * ( grp_res[task][roi][hemi]['h'][measure] - grp_res[task][roi][hemi]['i'][measure] ) )
-            else: 
-                value = int(grp_res[task][roi][hemi][cond][measure]*1000)
-            ds_res.samples[:,np.where(ds.samples==roi+h*1000)[1]]=value
-            print roi, hemi, value
-            #    if np.any(ds_res.samples<0):
-            #        ds_res.samples = ds_res.samples - ds_res.samples.min() # normalize location
-    ds_res_ni=P.map2nifti(ds_res, ds_res.samples)
-    ds_res_ni.to_filename('all_grp_res_%s_%s_%s.nii.gz'%(task, cond, measure))
+    Export group results as nifti file, see export_res_niftis
+    """
+    export_res_niftis(grp_res, [task], [cond], [measure], ref_subj)
     return True
 
+def export_res_niftis(grp_res, tsks=None, conds=['h','i','h-i','i-h'], measures=['mn'], ref_subj=subjects[0], outdir='.'):
+    """
+    Export group results as nifti files, one per task x cond x measure, from one parcellation load
+    Each map is filled from a label -> value lookup table with one fancy-index operation
+    Values are int(1000 * measure), or of the condition contrast for 'h-i' and 'i-h'
+
+    inputs:
+       grp_res - group results, see calc_group_results
+          tsks - tasks to export [None: all tasks in grp_res]
+         conds - conditions or contrasts to export [['h','i','h-i','i-h']]
+      measures - group result measures to export [['mn']]
+      ref_subj - subject whose PARCELLATION defines the rois [subjects[0]]
+        outdir - directory for the nifti files ['.']
+    outputs:
+        fnames - list of nifti files written, outdir/all_grp_res_<task>_<cond>_<measure>.nii.gz
+    """
+    tsks = sorted(grp_res.keys()) if tsks is None else tsks
+    ds = P.fmri_dataset(get_bids_file(ref_subj, 1, PARCELLATION)) # refence subject T2w MRISPACE PARCELLATION, could be done with T1w image?
+    labels = ds.samples[0].astype('int')
+    fnames = []
+    for task in tsks:
+        for cond in conds:
+            for measure in measures:
+                lut = np.zeros(labels.max()+1, dtype=ds.samples.dtype) # label -> value, 0 outside the rois
+                for roi in grp_res[task]:
+                    for hemi in grp_res[task][roi]:
+                        label = roi + 1000*(hemi=='RH')
+                        if label >= len(lut): # roi not in the parcellation
+                            continue
+                        r = grp_res[task][roi][hemi]
+                        if cond=='i-h':
+                            lut[label] = int( 1000 * ( r['i'][measure] - r['h'][measure] ) )
+                        elif cond=='h-i':
+                            lut[label] = int( 1000 * ( r['h'][measure] - r['i'][measure] ) )
+                        else: 
+                            lut[label] = int(r[cond][measure]*1000)
+                fname = opj(outdir, 'all_grp_res_%s_%s_%s.nii.gz'%(task, cond, measure))
+                P.map2nifti(ds, lut[labels][np.newaxis]).to_filename(fname)
+                print fname
+                fnames.append(fname)
+    return fnames
+
 def roi_analysis_hi(grp_res, h=True, i=True, t=0.05, task='pch-class', full_report=True, bilateral=False, tt='tt', ftxt=None):
     # Report rois shared / not shared between conditions
     if task[-1].lower()=='x':
@@ -1401,7 +2778,7 @@ def roi_analysis_fdr(grp_res, task='pch-class', cond='h', t=0.05, full_report=Tr
         print "No significant results"
     return mns, pvals, roi_idx
 
-def collate_model_results(show=False, n_null=1000, t=0.05, tt='tt', tasks=['pch-class','pch-classX','timbre','timbreX'], svdmap=0.0, autoenc=None, fdr_correct=True):
+def collate_model_results(show=False, n_null=1000, t=0.05, tt='tt', tasks=['pch-class','pch-classX','timbre','timbreX'], svdmap=0.0, autoenc=None, fdr_correct=True, incremental=False):
     """
     Load all results into a dictionary, indexed by directory name
     inputs:
@@ -1411,6 +2788,8 @@ def collate_model_results(show=False, n_null=1000, t=0.05, tt='tt', tasks=['pch-
           tt - which T-test to use 'tt' or 'wx' ['tt']
        tasks - list of task-results to load ['pch-class','pch-classX','timbre','timbreX']
      autoenc - whether to use autoenc 0=BOLD, 1=AUTOENC, None=[0,1] [None: load both BOLD and AUTOENC]
+ incremental - fold in only new or changed result parts, see update_group_results [False]
+               (subj_res is then loaded lazily)
     """
     autoenc_l = [0,1] if autoenc is None else [autoenc]
     subj_res = {}
@@ -1421,9 +2800,14 @@ def collate_model_results(show=False, n_null=1000, t=0.05, tt='tt', tasks=['pch-
                 if len(glob.glob(set_resultdir_by_params(delay, dur, n_null, autoenc, svdmap, update=False)))>0:
                     set_resultdir_by_params(delay, dur, n_null, autoenc, svdmap)
                     rname = spl(RESULTDIR)[1]
-                    subj_res[rname] = load_all_subj_res_from_parts(tasks)
-                    grp_res[rname+'_bl'] = calc_group_results(subj_res[rname], null_model=False)
-                    grp_res[rname+'_null'] = calc_group_results(subj_res[rname], null_model=True)
+                    if incremental:
+                        subj_res[rname] = load_all_subj_res_from_parts(tasks, lazy=True)
+                        grp_res[rname+'_bl'] = update_group_results(tsks=tasks, null_model=False)
+                        grp_res[rname+'_null'] = update_group_results(tsks=tasks, null_model=True)
+                    else:
+                        subj_res[rname] = load_all_subj_res_from_parts(tasks)
+                        grp_res[rname+'_bl'] = calc_group_results(subj_res[rname], null_model=False)
+                        grp_res[rname+'_null'] = calc_group_results(subj_res[rname], null_model=True)
     if show:
         #ftxt=open('all_res_models.txt','w')
         for k in sorted(grp_res.keys()):
@@ -1506,14 +2890,100 @@ def do_ds_task_cond_rois_clf(ds, task, cond, rois, n_null=0, delay=0, dur=1, aut
     print
     return res
                     
+def run_subj_tasks(subj, tsks, delays=[0], durs=[1], n_null=N_NULL, autoenc=0, svdmaps=[0.0], overwrite=0, ds=None, adaptive=False, trace=TRACE):
+    """
+    Classify subject BOLD data for several tasks and parameter settings in one process
+    The subject dataset is loaded once, and its preprocessed ROI matrices, ROI index and
+    autoencoder store are shared by all tasks and settings via the module-level caches.
+    Each (task, delay, dur, svdmap) writes its own result part to its own result directory.
+    Every (roi, hemi, cond) cell is checkpointed as it completes, a restarted job only
+    computes the cells missing from the checkpoint.
+
+    inputs:
+         subj - subject id
+         tsks - list of tasks
+       delays - list of delays in TRs relative to BOLD [[0]]
+         durs - list of event-related durations in TRs [[1]]
+       n_null - number of null models [N_NULL]
+      autoenc - 0=BOLD, 1=AUTOENC, 2=bilateral AUTOENC [0]
+      svdmaps - list of SVD proportions of variance [[0.0]]
+    overwrite - whether to overwrite existing result parts [0]
+           ds - subject dataset [None: get_subject_ds(subj)]
+     adaptive - stop null models early, n_null is then the maximum [False]
+        trace - write per-stage, per-cell timing and memory records next to each result part
+                ("%s_%s_trace.jsonl"%(subj,task)), see trace_stage [TRACE]
+    outputs:
+        fnames - list of result part files written
+    """
+    hemi_l = [0] if autoenc==2 else [0, 1000] # 2==bilateral
+    # Cortical regions of interest, group_results are L-R lateralized with R=roi_id + 1000
+    rois = get_LH_roi_keys()
+    fnames = []
+    trace_on, _trace['on'] = _trace['on'], bool(trace)
+    try:
+        for delay in delays:
+            for dur in durs:
+                for svdmap in svdmaps:
+                    # automatic resultdir detection
+                    path = set_resultdir_by_params(delay=delay, dur=dur, n_null=n_null, autoenc=autoenc, svdmap=svdmap, update=True, adaptive=adaptive)
+                    if not os.path.exists(path):
+                        print("Creating new result directory: %s"%path)
+                        os.mkdir(path)
+                    print("setting resultdir = %s"%path)
+                    for task in tsks:
+                        # default noclobber, optional clobber
+                        fname = "%s_%s_res_part.pickle"%(subj, task)
+                        if not overwrite and os.path.exists(opj(path, fname)):
+                            print("outfile file %s already exists and overwrite = %d, skipping..."%(fname, overwrite))
+                            continue
+                        print("task: %s, delay: %d, dur: %d, svdmap: %3.2f"%(task, delay, dur, svdmap))
+                        ctx = {'subj':subj, 'task':task, 'delay':delay, 'dur':dur, 'svdmap':svdmap, 'n_null':n_null, 'autoenc':autoenc} # trace context
+                        if overwrite:
+                            remove_checkpoint(subj, task, path)
+                        done, bad = load_checkpoint(subj, task, path) # bad cells are missing from done, so recomputed
+                        if done:
+                            print("resuming from %d checkpointed cells"%sum(len(done[roi][hemiL]) for roi in done for hemiL in done[roi]))
+                        res={}
+                        res[subj]={}
+                        res[subj][task]={}
+                        for roi in rois:
+                            res[subj][task][roi]={}
+                            for hemi in hemi_l:
+                                hemiL = 'LH' if not hemi else 'RH'
+                                res[subj][task][roi][hemiL]={}
+                                for cond in ['h','i']:
+                                    if cond in done.get(roi, {}).get(hemiL, {}) and done[roi][hemiL][cond].get('adaptive', False) == bool(adaptive):
+                                        res[subj][task][roi][hemiL][cond]=done[roi][hemiL][cond]
+                                        continue
+                                    set_trace_context(**ctx)
+                                    if ds is None:
+                                        with trace_stage('load'):
+                                            ds = get_subject_ds(subj)
+                                    set_trace_context(roi=roi, hemi=hemiL, cond=cond, **ctx)
+                                    with trace_stage('cell'):
+                                        res[subj][task][roi][hemiL][cond]=do_masked_subject_classification(ds, subj, task, cond, [roi+hemi], n_null=n_null, delay=delay, dur=dur, autoenc=autoenc, svdmap=svdmap, adaptive=adaptive)
+                                    save_checkpoint_cell(res[subj][task][roi][hemiL][cond], subj, task, roi, hemiL, cond, path)
+                        set_trace_context(**ctx)
+                        with trace_stage('save'):
+                            save_result_subj_task(res, subj, task)
+                            save_result_store(res, subj, task, delay, dur, n_null, autoenc, svdmap, adaptive=adaptive)
+                        remove_checkpoint(subj, task, path)
+                        if _trace['on']:
+                            save_trace(opj(path, "%s_%s_trace.jsonl"%(subj, task)))
+                        fnames.append(opj(path, fname))
+    finally:
+        _trace['on'] = trace_on
+        set_trace_context() # direct calls do not inherit the last cell's context
+    return fnames
+
 if __name__=="__main__":
     """
-    Classify subject BOLD data using task for all ROIs and save subject's results
-    Usage: python audimg sid00[0-9]{4} task{pch-height|pch-class|pch-hilo|timbre}    
+    Classify subject BOLD data using tasks for all ROIs and save subject's results, one part per task
+    Usage: python audimg sid00[0-9]{4} task[,task...] [delay[,delay...] dur[,dur...] n_null autoenc svdmap[,svdmap...] overwrite adaptive]
     """
     arg = 0
     if len(sys.argv) < 3:
-        print "Usage: %s sid00[0-9]{4} task{pch-height|pch-class|pch-hilo|timbre} [delay(int) dur(int) n_null(int)]"%sys.argv[arg]
+        print "Usage: %s sid00[0-9]{4} task[,task...]{pch-height|pch-class|pch-hilo|timbre} [delay(int)[,...] dur(int)[,...] n_null(int) autoenc(int) svdmap(float)[,...] overwrite(int) adaptive(int)]"%sys.argv[arg]
         sys.exit(1)
 
     arg += 1
@@ -1525,24 +2995,25 @@ if __name__=="__main__":
     print("subj: %s"%subj)
 
     arg += 1
-    task = sys.argv[arg] 
-    if task not in tasks:
-        print "%s not in tasks"%task
-        print "tasks:", tasks
-        sys.exit(1)        
-    print("task: %s"%task)
+    tsks = sys.argv[arg].split(',')
+    for task in tsks:
+        if task not in tasks:
+            print "%s not in tasks"%task
+            print "tasks:", tasks
+            sys.exit(1)        
+    print("tasks: %s"%', '.join(tsks))
 
     arg += 1
-    delay = 0 # if > 0, then delay targets relative to BOLD signal (in TRs)
+    delays = [0] # if > 0, then delay targets relative to BOLD signal (in TRs)
     if len(sys.argv) > arg:
-        delay = int(sys.argv[arg]) # delay in TRs relative to BOLD
-        print("setting delay = %d"%delay)
+        delays = [int(a) for a in sys.argv[arg].split(',')] # delay in TRs relative to BOLD
+        print("setting delay = %s"%delays)
         
     arg += 1
-    dur = 1 # if > 1, then form event-related dataset of this duration (in TRs) 
+    durs = [1] # if > 1, then form event-related dataset of this duration (in TRs) 
     if len(sys.argv) > arg:
-        dur = int(sys.argv[arg])   # form event-related dataset of duration in TRs 
-        print("setting duration = %d"%dur)
+        durs = [int(a) for a in sys.argv[arg].split(',')] # form event-related dataset of duration in TRs 
+        print("setting duration = %s"%durs)
 
     arg += 1
     n_null = N_NULL # compute null model by deault, use N_NULL models
@@ -1555,15 +3026,12 @@ if __name__=="__main__":
     if len(sys.argv) > arg:
         autoenc = int(sys.argv[arg]) # 0=False, 1=True, 2=bilateral
         print("setting autoenc = %d"%autoenc)
-    hemi_l = [0] if autoenc==2 else [0, 1000] # 2==bilateral
 
     arg += 1 
-    svdmap = 0.0
+    svdmaps = [0.0]
     if len(sys.argv) > arg:
-        svdmap = float(sys.argv[arg])
-        svdmap = 1.0 if svdmap>1.0 else svdmap
-        svdmap = 0.0 if svdmap<0.0 else svdmap
-        print("setting svdmap = %3.2f"%svdmap)
+        svdmaps = [min(max(float(a), 0.0), 1.0) for a in sys.argv[arg].split(',')]
+        print("setting svdmap = %s"%svdmaps)
 
     arg += 1 
     overwrite = 0
@@ -1571,37 +3039,10 @@ if __name__=="__main__":
         overwrite = int(sys.argv[arg])
         print("setting overwrite = %d"%overwrite)
 
-    # automatic resultdir detection
-    path = set_resultdir_by_params(delay=delay, dur=dur, n_null=n_null, autoenc=autoenc, svdmap=svdmap, update=True)
-    def chkpath(path, fail=False):  
-        if not os.path.exists(path):
-            if fail:
-                ValueError("Result directory does not exist: %s"%path)
-            else:
-                print("Creating new result directory: %s"%path)
-                os.mkdir(path)
-        return True
-    chkpath(path, False) # mkdir if not exist
-    chkpath(path, True) # fail if not exist
-    print("setting resultdir = %s"%path)
-
-    # default noclobber, optional clobber 
-    fname = "%s_%s_res_part.pickle"%(subj, task)
-    if not overwrite and os.path.exists(opj(path, fname)):
-        print("outfile file %s already exists and overwrite = %d, exiting..."%(fname, overwrite))
-        sys.exit(0)
+    arg += 1
+    adaptive = 0
+    if len(sys.argv) > arg:
+        adaptive = int(sys.argv[arg]) # 1=stop null models early, n_null is the maximum
+        print("setting adaptive = %d"%adaptive)
 
-    # Cortical regions of interest, group_results are L-R lateralized with R=roi_id + 1000
-    rois = get_LH_roi_keys()
-    ds=get_subject_ds(subj)
-    res={}
-    res[subj]={}
-    res[subj][task]={}
-    for roi in rois:
-        res[subj][task][roi]={}
-        for hemi in hemi_l:                          
-            hemiL = 'LH' if not hemi else 'RH'
-            res[subj][task][roi][hemiL]={}            
-            for cond in ['h','i']:
-                res[subj][task][roi][hemiL][cond]=do_masked_subject_classification(ds, subj, task, cond, [roi+hemi], n_null=n_null, delay=delay, dur=dur, autoenc=autoenc, svdmap=svdmap)
-    save_result_subj_task(res, subj, task)
+    run_subj_tasks(subj, tsks, delays, durs, n_null, autoenc, svdmaps, overwrite, adaptive=adaptive)
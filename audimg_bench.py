@@ -0,0 +1,358 @@
+"""
+audimg_bench.py
+Offline benchmark of the audimg.py decoding pipeline on synthetic data
+Michael A. Casey, Dartmouth College, Aug-Dec 2019
+
+Builds a small synthetic fmriprep tree (BOLD runs, parcellations, targets, subject
+and run legends, autoencoder pickles) under a temporary ROOTDIR, times each stage
+of the pipeline and checks that the optimised paths give the same results as the
+reference paths on fixed seeds
+Usage: python audimg_bench.py [n_subj n_vox(per axis) roi_size n_rois n_null n_events]
+"""
+
+import numpy as np
+import os
+import os.path
+from os.path import join as opj
+import sys
+import time
+import pickle
+import shutil
+import tempfile
+from contextlib import contextmanager
+
+BENCH_SUBJS=3 # synthetic subjects
+BENCH_VOX=16 # volume is BENCH_VOX^3 voxels
+BENCH_ROI_SIZE=60 # voxels per ROI
+BENCH_ROIS=4 # LH rois in the parcellation (and their RH counterparts)
+BENCH_NULL=20 # null models per (roi, hemi, cond)
+BENCH_EVENTS=14 # pitch events per run, 2 TRs each followed by 2 rest TRs
+BENCH_SEED=0 # seed of the synthetic data
+BENCH_TASKS=['pch-class','timbre','pch-classX'] # tasks of the classification stages
+
+A = None # audimg, imported once ROOTDIR is set, see _import_audimg
+
+_PCS = [0,2,4,5,7,9,11] # diatonic pitch classes relative to the key
+_RUN_TASKS = ['heardXtrum','heardXclar','imagXtrum','imagXclar'] # run order, repeated
+
+def _subject_ids(n_subj):
+    """
+    Utility function
+    Synthetic subject ids, accession numbers and keys
+    """
+    return [('sid9%05d'%(i+1), 'A9%05d'%(i+1), 'EF'[i%2]) for i in range(n_subj)]
+
+def _write_subject_maps(rootdir, n_subj):
+    """
+    Utility function
+    Write the subject id map and run legend read by audimg.py at import
+    """
+    with open(opj(rootdir, 'subj-id-accession-key.csv'), 'wt') as f:
+        f.write('subj_num,subj_id,accession_num,key\n')
+        for i, (subj, acc, key) in enumerate(_subject_ids(n_subj)):
+            f.write('%d,%s,%s,%s\n'%(i+1, subj.upper(), acc, key))
+    with open(opj(rootdir, 'subj_task_run_list.txt'), 'wt') as f:
+        for subj, acc, key in _subject_ids(n_subj):
+            for run in range(1, 9):
+                f.write('%s_task-pitch%sX%s_run-%02d\n'%(subj, _RUN_TASKS[(run-1)%4], key, run))
+
+def _import_audimg(rootdir):
+    """
+    Utility function
+    Import audimg with ROOTDIR=rootdir
+    """
+    global A
+    os.environ['AUDIMG_ROOTDIR'] = rootdir
+    import audimg
+    if audimg.ROOTDIR != rootdir:
+        raise ImportError("audimg was imported with ROOTDIR=%s before the benchmark"%audimg.ROOTDIR)
+    A = audimg
+    return A
+
+def make_synthetic_tree(rootdir, n_subj=BENCH_SUBJS, n_vox=BENCH_VOX, roi_size=BENCH_ROI_SIZE, n_rois=BENCH_ROIS, n_events=BENCH_EVENTS, seed=BENCH_SEED):
+    """
+    Build a synthetic fmriprep tree under rootdir and import audimg on it
+    ROI voxels carry a weak pitch-class and timbre pattern, all voxels have noise and a linear trend
+
+    inputs:
+       rootdir - empty directory to use as ROOTDIR
+        n_subj - number of subjects [BENCH_SUBJS]
+         n_vox - voxels per volume axis [BENCH_VOX]
+      roi_size - voxels per ROI [BENCH_ROI_SIZE]
+        n_rois - number of LH rois (each with a RH counterpart) [BENCH_ROIS]
+      n_events - pitch events per run [BENCH_EVENTS]
+          seed - random seed [BENCH_SEED]
+    outputs:
+          rois - the LH rois in the parcellation
+    """
+    rng = np.random.RandomState(seed)
+    _write_subject_maps(rootdir, n_subj)
+    _import_audimg(rootdir)
+    rois = A.get_LH_roi_keys()[:n_rois]
+    labels = rois + [roi+1000 for roi in rois]
+    if roi_size * len(labels) > n_vox**3:
+        raise ValueError("%d rois of %d voxels do not fit in %d^3 voxels"%(len(labels), roi_size, n_vox))
+    os.makedirs(opj(rootdir, 'targets'))
+    affine = np.diag([3., 3., 3., 1.])
+    for subj, acc, key in _subject_ids(n_subj):
+        funcdir = opj(A.DATADIR, 'sub-%s'%subj, 'func')
+        os.makedirs(funcdir)
+        parc = np.zeros(n_vox**3, dtype='int16')
+        parc[rng.permutation(n_vox**3)[:roi_size*len(labels)]] = np.repeat(labels, roi_size)
+        patterns = rng.randn(12 + 2, n_vox**3) * (parc > 0) # pitch-class and timbre patterns in roi voxels
+        key_ref = 52 if key=='E' else 53
+        ae_blocks = dict((roi, []) for roi in rois)
+        for run in range(1, 9):
+            stem = 'sub-%s_task-pitch%sX%s_run-%02d_space-%s'%(subj, _RUN_TASKS[(run-1)%4], key, run, A.MRISPACE)
+            nib_parc = A.P.nib.Nifti1Image(parc.reshape((n_vox,)*3), affine)
+            nib_parc.to_filename(opj(funcdir, '%s_%s.nii.gz'%(stem, A.PARCELLATION)))
+            pcs = np.array(_PCS)[rng.permutation(np.arange(n_events) % len(_PCS))]
+            tgts = np.vstack([100 + key_ref + pcs, 100 + key_ref + pcs, np.ones(n_events), np.ones(n_events) + 1]).T.reshape(-1).astype('int')
+            np.savetxt(opj(rootdir, 'targets', '%s_run-%02d.txt'%(acc, run)), tgts, fmt='%d')
+            bold = rng.randn(len(tgts), n_vox**3) + np.linspace(0, 1, len(tgts))[:, np.newaxis]
+            pitch = tgts > 99
+            bold[pitch] += 0.5 * patterns[(tgts[pitch] - key_ref) % 100 % 12] + 0.5 * patterns[12 + run % 2]
+            img = A.P.nib.Nifti1Image(bold.T.reshape((n_vox,)*3 + (len(tgts),)).astype('float32'), affine)
+            img.header.set_zooms((3., 3., 3., 2.))
+            img.to_filename(opj(funcdir, '%s_%s.nii.gz'%(stem, A.BOLD)))
+            for roi in rois:
+                ae_blocks[roi].append((tgts, bold[:, (parc==roi) | (parc==roi+1000)]))
+        # autoencoded rois: a random projection of the roi's BOLD, runs in get_subject_ds order
+        swap_timbres=[2,1,4,3,6,5,8,7]
+        order = [run if A.legend[acc][0]=='HT' else swap_timbres[run-1] for run in range(1, 9)]
+        for roi in rois:
+            w = rng.randn(2*roi_size, roi_size // 4)
+            samples = np.vstack([np.dot(ae_blocks[roi][r-1][1], w) for r in order])
+            targets = np.hstack([ae_blocks[roi][r-1][0] for r in order])
+            chunks = np.hstack([np.ones(len(ae_blocks[roi][r-1][0]), dtype='int')*(i+1) for i, r in enumerate(order)])
+            os.makedirs(opj(A.AUTOENCDIR, subj, '%d'%roi))
+            for ext, cols in [('lh', slice(0, roi_size // 8)), ('rh', slice(roi_size // 8, roi_size // 4)), ('lrh', slice(0, roi_size // 4))]:
+                with open(opj(A.AUTOENCDIR, subj, '%d'%roi, 'transformed_%s.p'%ext), 'wb') as f:
+                    pickle.dump(A.P.Dataset(samples[:, cols], sa={'targets':targets, 'chunks':chunks}), f)
+    return rois
+
+def _reference_subject_ds(subject):
+    """
+    Utility function
+    Reference loader: one P.fmri_dataset per run, stacked
+    """
+    swap_timbres=[2,1,4,3,6,5,8,7]
+    data = []
+    for run in range(1,9):
+        r=run if A.legend[A.accessions[subject]][0]=='HT' else swap_timbres[run-1]
+        tgts=np.loadtxt(opj(A.ROOTDIR, 'targets', A.accessions[subject]+'_run-%02d.txt'%r)).astype('int')
+        data.append(A.P.fmri_dataset(A.get_bids_file(subject, r, A.BOLD), targets=tgts, chunks=run))
+    data = A.P.vstack(data, a=0)
+    data.subject = subject
+    return data
+
+def _reference_mask_subject_ds(ds, subj, rois):
+    """
+    Utility function
+    Reference masking: P.fmri_dataset with the roi mask, then detrend and z-score
+    """
+    mask = A.get_subject_mask(subj, run=1, rois=rois)
+    ds_masked = A.P.fmri_dataset(A.P.map2nifti(ds), ds.targets, ds.chunks, A.P.map2nifti(mask))
+    A.P.poly_detrend(ds_masked, polyord=1, chunks_attr='chunks')
+    A.P.zscore(ds_masked, param_est=('targets', [1,2]))
+    return ds_masked
+
+_timings = [] # (stage, seconds)
+_checks = [] # (check, passed)
+
+@contextmanager
+def _stage(name):
+    """
+    Utility function
+    Time a benchmark stage
+    """
+    t0 = time.time()
+    yield
+    _timings.append((name, time.time() - t0))
+
+def _check(name, passed):
+    """
+    Utility function
+    Record a reference check
+    """
+    _checks.append((name, bool(passed)))
+    if not passed:
+        print("FAIL: %s"%name)
+
+def _acc(r):
+    """
+    Utility function
+    Accuracy of a do_subj_classification result
+    """
+    return (r['res'][0]==r['res'][1]).mean()
+
+def run_benchmark(rootdir, n_null=BENCH_NULL, n_jobs=2, tsks=BENCH_TASKS):
+    """
+    Time each pipeline stage on the synthetic tree and check optimised against reference paths
+
+    inputs:
+     rootdir - synthetic ROOTDIR, see make_synthetic_tree
+      n_null - null models per (roi, hemi, cond) [BENCH_NULL]
+      n_jobs - worker processes for the parallel null models [2]
+        tsks - tasks of the classification stages [BENCH_TASKS]
+    outputs:
+     timings - list of (stage, seconds)
+      checks - list of (check, passed)
+    """
+    subjs = A.subjects
+    rois = sorted(set(roi % 1000 + 1000 for labels in [A.get_subject_roi_index(s) for s in subjs] for roi in labels))
+    hemis = [('LH', 0), ('RH', 1000)]
+    resultdir = opj(rootdir, 'results_bench')
+    os.mkdir(resultdir)
+    ds = {}
+    for subj in subjs:
+        with _stage('get_subject_ds'):
+            ds[subj] = A.get_subject_ds(subj)
+        with _stage('get_subject_ds (reference)'):
+            ds_ref = _reference_subject_ds(subj)
+        _check('get_subject_ds %s samples'%subj, np.array_equal(ds[subj].samples, ds_ref.samples) and np.array_equal(ds[subj].targets, ds_ref.targets) and np.array_equal(ds[subj].chunks, ds_ref.chunks))
+    subj = subjs[0]
+    for roi in rois:
+        for hemiL, hemi in hemis:
+            with _stage('mask_subject_ds'):
+                ds_masked = A.mask_subject_ds(ds[subj], subj, [roi+hemi])
+            with _stage('mask_subject_ds (reference)'):
+                ds_ref = _reference_mask_subject_ds(ds[subj], subj, [roi+hemi])
+            _check('mask_subject_ds %d samples'%(roi+hemi), np.allclose(ds_masked.samples, ds_ref.samples, atol=1e-6))
+            for task in tsks:
+                for cond in ['h', 'i']:
+                    with _stage('do_subj_classification'):
+                        acc = _acc(A.do_subj_classification(ds_masked, subj, task, cond))
+                    acc_ref = _acc(A.do_subj_classification(ds_ref, subj, task, cond))
+                    _check('do_subj_classification %s %d %s accuracy'%(task, roi+hemi, cond), acc == acc_ref)
+    ds_ae_ref = {}
+    for roi in rois:
+        for hemiL, hemi in hemis:
+            with _stage('get_autoencoded_subject_ds (pickles)'):
+                ds_ae_ref[roi+hemi] = A.get_autoencoded_subject_ds(ds[subj], subj, [roi+hemi])
+    with _stage('pack_autoencoded_subject_ds'):
+        A.pack_autoencoded_subject_ds(subj, rois)
+    A._ae_store.clear() # forget that the subject was not packed
+    for roi in rois:
+        for hemiL, hemi in hemis:
+            with _stage('get_autoencoded_subject_ds (store)'):
+                ds_ae = A.get_autoencoded_subject_ds(ds[subj], subj, [roi+hemi])
+            _check('get_autoencoded_subject_ds %d store'%(roi+hemi), np.array_equal(ds_ae.samples, ds_ae_ref[roi+hemi].samples))
+    ds_masked = A.mask_subject_ds(ds[subj], subj, [rois[0]])
+    with _stage('null models (1 process)'):
+        null_1 = A.run_null_models(ds_masked, subj, 'pch-class', 'h', n_null, n_jobs=1)
+    with _stage('null models (%d processes)'%n_jobs):
+        null_n = A.run_null_models(ds_masked, subj, 'pch-class', 'h', n_null, n_jobs=n_jobs)
+    _check('run_null_models n_jobs=1 == n_jobs=%d'%n_jobs, np.array_equal(null_1, null_n))
+    ds_enc = A._encode_task_condition_targets(ds_masked, subj, 'pch-class', 'h') # one cell, as do_masked_subject_classification
+    with _stage('null models (kernel, cell Gram)'):
+        null_k = A.run_null_models(ds_enc, subj, 'pch-class', 'h', n_null, n_jobs=1, backend='kernel', encoded=True)
+    _check('kernel == svm null accuracies', np.array_equal(null_k, null_1))
+    for task in tsks:
+        for cond in ['h', 'i']:
+            r_k = A.do_subj_classification(ds_masked, subj, task, cond, backend='kernel')
+            r_s = A.do_subj_classification(ds_masked, subj, task, cond)
+            _check('kernel == svm predictions %s %s'%(task, cond), np.array_equal(r_k['res'][1], r_s['res'][1]))
+    with _stage('null models (ridge, one pass)'):
+        null_r = A.run_null_models(ds_masked, subj, 'pch-class', 'h', n_null, backend='ridge')
+    null_rb = np.r_[A.run_null_models(ds_masked, subj, 'pch-class', 'h', n_null // 2, backend='ridge'),
+                    A.run_null_models(ds_masked, subj, 'pch-class', 'h', n_null - n_null // 2, start=n_null // 2, backend='ridge')]
+    _check('ridge null models in blocks == one pass', np.array_equal(null_r, null_rb))
+    cell_cache = A.CELL_CACHE
+    try:
+        with _stage('null models (svdmap, cell cache)'):
+            null_c = A.run_null_models(ds_enc, subj, 'pch-class', 'h', n_null, n_jobs=1, svdmap=0.9, encoded=True)
+        A.CELL_CACHE = 0
+        with _stage('null models (svdmap, uncached)'):
+            null_u = A.run_null_models(ds_enc, subj, 'pch-class', 'h', n_null, n_jobs=1, svdmap=0.9, encoded=True)
+        _check('svd mapper cell cache null accuracies', np.array_equal(null_c, null_u))
+    finally:
+        A.CELL_CACHE = cell_cache
+    precision = A.PRECISION
+    try:
+        acc, acc_ref = [], []
+        for p, accs in [('float32', acc), ('float64', acc_ref)]:
+            A.PRECISION = p
+            with _stage('get_subject_ds (%s)'%p):
+                ds_p = A.get_subject_ds(subj) # precision from A.PRECISION
+            print("%s samples: %.1f MB"%(p, ds_p.samples.nbytes / 1e6))
+            _check('get_subject_ds %s samples dtype'%p, ds_p.samples.dtype == p)
+            for roi in rois:
+                for hemiL, hemi in hemis:
+                    with _stage('mask_subject_ds (%s)'%p):
+                        ds_masked = A.mask_subject_ds(ds_p, subj, [roi+hemi])
+                    _check('mask_subject_ds %s samples dtype %d'%(p, roi+hemi), ds_masked.samples.dtype == p)
+                    for task in tsks:
+                        for cond in ['h', 'i']:
+                            with _stage('do_subj_classification (%s)'%p):
+                                accs.append(_acc(A.do_subj_classification(ds_masked, subj, task, cond)))
+        mismatch = np.sum(np.array(acc) != acc_ref)
+        print("float32 / float64 accuracy mismatches: %d/%d cells"%(mismatch, len(acc)))
+        _check('float32 == float64 accuracy, every cell', mismatch == 0)
+    finally:
+        A.PRECISION = precision
+    for subj in subjs:
+        for task in tsks:
+            res = {subj:{task:{}}}
+            for roi in rois:
+                res[subj][task][roi] = {}
+                for hemiL, hemi in hemis:
+                    res[subj][task][roi][hemiL] = {}
+                    for cond in ['h', 'i']:
+                        with _stage('do_masked_subject_classification'):
+                            res[subj][task][roi][hemiL][cond] = A.do_masked_subject_classification(ds[subj], subj, task, cond, [roi+hemi], n_null=n_null, autoenc=False, returntrials=True, n_jobs=1)
+            with _stage('save_result_subj_task + save_result_store'):
+                A.save_result_subj_task(res, subj, task, resultdir)
+                A.save_result_store(res, subj, task, n_null=n_null, resultdir=resultdir)
+    with _stage('load_all_subj_res_from_parts (store)'):
+        subj_res = A.load_all_subj_res_from_parts(tsks, subjs, resultdir)
+    for f in os.listdir(opj(resultdir, A.RESULTSTORE)):
+        os.rename(opj(resultdir, A.RESULTSTORE, f), opj(resultdir, f + '.bak'))
+    with _stage('load_all_subj_res_from_parts (pickles)'):
+        subj_res_ref = A.load_all_subj_res_from_parts(tsks, subjs, resultdir)
+    _check('result store == pickled parts', all(subj_res[s][t][roi][h][c]['mn'] == subj_res_ref[s][t][roi][h][c]['mn'] for s in subjs for t in tsks for roi in rois for h, _ in hemis for c in ['h', 'i']))
+    for null_model in [True, False]:
+        with _stage('calc_group_results (vectorized)'):
+            grp = A.calc_group_results(subj_res_ref, null_model=null_model)
+        with _stage('calc_group_results (per cell)'):
+            grp_ref = A.calc_group_results(subj_res_ref, null_model=null_model, vectorized=False)
+        with _stage('update_group_results'):
+            grp_inc = A.update_group_results(resultdir, tsks, subjs, null_model=null_model)
+        for g, name in [(grp, 'vectorized'), (grp_inc, 'incremental')]:
+            _check('calc_group_results %s null_model=%s'%(name, null_model), all(
+                np.allclose([g[t][roi][h][c][k][0] for k in ['tt', 'wx']], [grp_ref[t][roi][h][c][k][0] for k in ['tt', 'wx']], equal_nan=True) and
+                np.allclose(g[t][roi][h][c]['mn'], grp_ref[t][roi][h][c]['mn'])
+                for t in tsks for roi in rois for h, _ in hemis for c in ['h', 'i']))
+    return _timings, _checks
+
+def report(timings, checks):
+    """
+    Print total time per stage (and number of calls), and the reference checks
+    """
+    stages = []
+    for name, dt in timings:
+        if name not in stages:
+            stages.append(name)
+    print("%-45s %6s %10s"%('stage', 'calls', 'seconds'))
+    for name in stages:
+        dts = [dt for n, dt in timings if n == name]
+        print("%-45s %6d %10.3f"%(name, len(dts), sum(dts)))
+    print("%d/%d checks passed"%(sum(p for n, p in checks), len(checks)))
+
+if __name__=="__main__":
+    """
+    Build a synthetic tree in a temporary directory, run the benchmark and remove the tree
+    Usage: python audimg_bench.py [n_subj n_vox(per axis) roi_size n_rois n_null n_events]
+    """
+    args = [int(a) for a in sys.argv[1:]]
+    defaults = [BENCH_SUBJS, BENCH_VOX, BENCH_ROI_SIZE, BENCH_ROIS, BENCH_NULL, BENCH_EVENTS]
+    n_subj, n_vox, roi_size, n_rois, n_null, n_events = args + defaults[len(args):]
+    rootdir = tempfile.mkdtemp(prefix='audimg_bench_')
+    try:
+        with _stage('make_synthetic_tree'):
+            make_synthetic_tree(rootdir, n_subj, n_vox, roi_size, n_rois, n_events)
+        timings, checks = run_benchmark(rootdir, n_null)
+        report(timings, checks)
+    finally:
+        shutil.rmtree(rootdir, ignore_errors=True)
+    sys.exit(0 if all(p for n, p in _checks) else 1)
@@ -0,0 +1,256 @@
+"""
+audimg_sched.py
+Work scheduler for audimg.py classifier runs
+Michael A. Casey, Dartmouth College, Aug-Dec 2019
+
+Enumerates subject x task x roi x hemi x cond work units, skips completed ones,
+runs the rest on a local process pool (largest first), or packs them into batch
+job scripts for the TORQUE queue (mksub)
+"""
+
+import audimg as A
+import os
+import os.path
+from os.path import join as opj
+import sys
+import time
+import multiprocessing
+
+SCHED_TASKS=['pch-class','timbre','pch-classX','timbreX','pch-height'] # tasks run by default, as qsub_audimg_subj_task.sh
+CONDS=['h','i'] # heard, imagined
+QSUB_TEMPLATE='run_audimg_subj_task.qsub' # PBS header for batch job scripts
+BATCHDIR='audimg_batches' # batch job scripts and their submit.sh
+REPORT_EVERY=10 # seconds between throughput reports
+
+def get_hemis(autoenc=0):
+    """
+    Hemisphere keys and roi offsets, as the __main__ roi loop in audimg.py
+    """
+    return [('LH',0)] if autoenc==2 else [('LH',0), ('RH',1000)] # 2==bilateral
+
+def get_resultdir(delay=0, dur=1, n_null=A.N_NULL, autoenc=0, svdmap=0.0):
+    """
+    The result directory audimg.py writes to for these parameters (does not change A.RESULTDIR)
+    """
+    return A.set_resultdir_by_params(delay=delay, dur=dur, n_null=n_null, autoenc=autoenc, svdmap=svdmap, update=False)
+
+def _unit_cost(subj, roi, n_null, autoenc=0):
+    """
+    Utility function
+    Relative cost of a work unit: ROI features x (number of null models + 1)
+    Features are BOLD voxels, or autoencoder dimensions if autoenc (from the packed store)
+    """
+    if autoenc:
+        store = A._get_ae_store(subj)
+        index = store.a.ae_index if store is not None else {}
+        first, last = index.get((roi if roi < 2000 else roi - 1000, 'lh' if roi < 2000 else 'rh'), (0, 1)) # not packed, all rois cost the same
+        n_feat = last - first
+    else:
+        try:
+            n_feat = len(A.get_subject_roi_index(subj).get(roi, ()))
+        except (IOError, OSError):
+            n_feat = 1 # parcellation not available here, all rois cost the same
+    return max(n_feat, 1) * (n_null + 1)
+
+def get_work_units(subjs=None, tsks=SCHED_TASKS, rois=None, delay=0, dur=1, n_null=A.N_NULL, autoenc=0, svdmap=0.0, overwrite=0):
+    """
+    Enumerate remaining work units, largest first within each subject
+    Every (subj,task) without a result part also gets a finalize unit (subj, task, None, None, None),
+    which assembles and saves the part from its checkpoint, even if all of its cells are checkpointed
+
+    inputs:
+         subjs - list of subjects [None: A.subjects]
+          tsks - list of tasks [SCHED_TASKS]
+          rois - list of LH roi keys [None: A.get_LH_roi_keys()]
+         delay, dur, n_null, autoenc, svdmap - audimg.py run parameters
+     overwrite - whether to include units whose (subj,task) result part or cell checkpoint exists [0]
+    outputs:
+         units - list of (cost, (subj, task, roi, hemi, cond)), subjects in order of total cost
+    """
+    subjs = A.subjects if subjs is None else subjs
+    rois = A.get_LH_roi_keys() if rois is None else rois
+    resultdir = get_resultdir(delay, dur, n_null, autoenc, svdmap)
+    by_subj = []
+    for subj in subjs:
+        todo = [task for task in tsks if overwrite or not os.path.exists(opj(resultdir, "%s_%s_res_part.pickle"%(subj, task)))]
+        if not todo:
+            continue
+        units = []
+        for roi in rois:
+            for hemi, offset in get_hemis(autoenc):
+                cost = _unit_cost(subj, roi+offset, n_null, autoenc)
+                units.extend((cost, (subj, task, roi, hemi, cond)) for task in todo for cond in CONDS
+                             if overwrite or not os.path.exists(A.checkpoint_cell_file(subj, task, roi, hemi, cond, resultdir)))
+        units.extend((0, (subj, task, None, None, None)) for task in todo)
+        units.sort(key=lambda u: -u[0])
+        by_subj.append(units)
+    by_subj.sort(key=lambda units: -sum(u[0] for u in units))
+    return [u for subj_units in by_subj for u in subj_units]
+
+_worker_ds = {} # the subject dataset held by a pool worker, one subject at a time
+
+def _run_unit(job):
+    """
+    Utility function
+    Pool worker: classify one work unit, null models run in this process
+    """
+    (subj, task, roi, hemi, cond), params = job
+    if subj not in _worker_ds:
+        _worker_ds.clear()
+        _worker_ds[subj] = A.get_subject_ds(subj)
+    offset = dict(get_hemis(params['autoenc']))[hemi]
+    t0 = time.time()
+    r = A.do_masked_subject_classification(_worker_ds[subj], subj, task, cond, [roi+offset], n_null=params['n_null'],
+                                           delay=params['delay'], dur=params['dur'], autoenc=params['autoenc'],
+                                           svdmap=params['svdmap'], n_jobs=1)
+    return (subj, task, roi, hemi, cond), r, time.time() - t0
+
+def _save_part(subj, task, params, resultdir):
+    """
+    Utility function
+    Assemble a (subj,task) result part from its checkpoint and save it
+    Cells missing from the checkpoint (unreadable, or lost) are recomputed in this process first,
+    so an incomplete part is never saved
+    """
+    cells, bad = A.load_checkpoint(subj, task, resultdir)
+    for roi in A.get_LH_roi_keys():
+        for hemi, offset in get_hemis(params['autoenc']):
+            for cond in CONDS:
+                if cond not in cells.get(roi, {}).get(hemi, {}):
+                    print("recomputing missing cell %s %s %d %s %s"%(subj, task, roi, hemi, cond))
+                    unit, r, dt = _run_unit(((subj, task, roi, hemi, cond), params))
+                    A.save_checkpoint_cell(r, subj, task, roi, hemi, cond, resultdir)
+                    cells.setdefault(roi, {}).setdefault(hemi, {})[cond] = r
+    part = {subj:{task:cells}}
+    A.save_result_subj_task(part, subj, task, resultdir)
+    A.save_result_store(part, subj, task, params['delay'], params['dur'], params['n_null'], params['autoenc'], params['svdmap'], resultdir)
+    A.remove_checkpoint(subj, task, resultdir)
+
+def run_local(units, delay=0, dur=1, n_null=A.N_NULL, autoenc=0, svdmap=0.0, n_jobs=None):
+    """
+    Run work units on a local process pool, in the given (largest first) order
+    Each unit is checkpointed as it completes, a (subj,task) result part is saved
+    from its checkpoint as soon as all of its units are done (finalize units, see get_work_units)
+
+    inputs:
+         units - list of (cost, unit) from get_work_units
+         delay, dur, n_null, autoenc, svdmap - audimg.py run parameters
+        n_jobs - number of worker processes [None: multiprocessing.cpu_count()]
+    outputs:
+         parts - list of (subj, task) result parts written
+    """
+    n_jobs = multiprocessing.cpu_count() if n_jobs is None else n_jobs
+    params = {'delay':delay, 'dur':dur, 'n_null':n_null, 'autoenc':autoenc, 'svdmap':svdmap}
+    resultdir = A.set_resultdir_by_params(delay=delay, dur=dur, n_null=n_null, autoenc=autoenc, svdmap=svdmap, update=True)
+    if not os.path.exists(resultdir):
+        print("Creating new result directory: %s"%resultdir)
+        os.mkdir(resultdir)
+    remaining = {}
+    cost = {}
+    for c, unit in units:
+        remaining.setdefault(unit[:2], 0)
+        if unit[2] is not None: # cell unit, else finalize unit
+            remaining[unit[:2]] += 1
+            cost[unit] = c
+    cells = [unit for c, unit in units if unit[2] is not None]
+    total_cost = float(sum(cost.values()))
+    parts = []
+    for subj, task in sorted(remaining): # all cells already checkpointed
+        if not remaining[(subj, task)]:
+            _save_part(subj, task, params, resultdir)
+            parts.append((subj, task))
+    if not cells:
+        return parts
+    done, done_cost, t0, last = 0, 0, time.time(), time.time()
+    pool = multiprocessing.Pool(n_jobs)
+    try:
+        for unit, r, dt in pool.imap_unordered(_run_unit, [(unit, params) for unit in cells]):
+            subj, task, roi, hemi, cond = unit
+            A.save_checkpoint_cell(r, subj, task, roi, hemi, cond, resultdir)
+            done += 1
+            done_cost += cost[unit]
+            remaining[(subj, task)] -= 1
+            if not remaining[(subj, task)]:
+                _save_part(subj, task, params, resultdir)
+                parts.append((subj, task))
+            now = time.time()
+            if now - last >= REPORT_EVERY or done == len(cells):
+                rate = done_cost / (now - t0)
+                print("%d/%d units, %d parts, %.2f units/s, eta %.0fs"%(done, len(cells), len(parts), done / (now - t0), (total_cost - done_cost) / rate if rate else 0))
+                sys.stdout.flush()
+                last = now
+    finally:
+        pool.close()
+        pool.join()
+    return parts
+
+def write_batches(units, n_batches, delay=0, dur=1, n_null=A.N_NULL, autoenc=0, svdmap=0.0, overwrite=0, batchdir=BATCHDIR, template=QSUB_TEMPLATE):
+    """
+    Pack work units into n_batches job scripts of about equal cost for the queue
+    Units are grouped into one audimg.py command per subject (all its tasks, subject data loaded once),
+    a task with only a finalize unit is still run (audimg.py resumes from the checkpoint and saves the part),
+    commands are assigned largest first to the least loaded batch
+    Submit with: . batchdir/submit.sh
+
+    inputs:
+         units - list of (cost, unit) from get_work_units
+     n_batches - number of batch jobs
+         delay, dur, n_null, autoenc, svdmap, overwrite - audimg.py run parameters
+      batchdir - directory for batch job scripts [BATCHDIR]
+      template - qsub script whose PBS header is used for the batch scripts [QSUB_TEMPLATE]
+    outputs:
+       fnames - list of batch job scripts written
+    """
+    jobs = {}
+    for c, (subj, task, roi, hemi, cond) in units:
+        cost, tsks = jobs.setdefault(subj, [0, []])
+        jobs[subj][0] += c
+        if task not in tsks:
+            tsks.append(task)
+    batches = [[0, []] for b in range(min(n_batches, len(jobs)))]
+    for subj in sorted(jobs, key=lambda s: -jobs[s][0]):
+        batch = min(batches, key=lambda b: b[0])
+        batch[0] += jobs[subj][0]
+        batch[1].append("python audimg.py %s %s %d %d %d %d %3.2f %d"%(subj, ','.join(jobs[subj][1]), delay, dur, n_null, autoenc, svdmap, overwrite))
+    with open(template, 'rt') as f:
+        header = [l.rstrip('\n') for l in f if 'audimg.py' not in l and l.strip() != 'exit 0']
+    if not os.path.exists(batchdir):
+        os.mkdir(batchdir)
+    fnames = []
+    for b, (cost, cmds) in enumerate(batches):
+        fname = opj(batchdir, 'audimg_batch_%03d.qsub'%b)
+        with open(fname, 'wt') as f:
+            f.write('\n'.join(header + [l for cmd in cmds for l in ['echo '+cmd, cmd]] + ['exit 0']) + '\n')
+        fnames.append(fname)
+    with open(opj(batchdir, 'submit.sh'), 'wt') as f:
+        f.write('#!/bin/bash\n' + ''.join('mksub %s\n'%fname for fname in fnames))
+    return fnames
+
+if __name__=="__main__":
+    """
+    Schedule the remaining audimg.py work units for all subjects
+    Usage: python audimg_sched.py {local|qsub} [delay(int) dur(int) n_null(int) autoenc(int) svdmap(float) n_jobs|n_batches(int) overwrite(int)]
+    """
+    if len(sys.argv) < 2 or sys.argv[1] not in ['local', 'qsub']:
+        print("Usage: %s {local|qsub} [delay(int) dur(int) n_null(int) autoenc(int) svdmap(float) n_jobs|n_batches(int) overwrite(int)]"%sys.argv[0])
+        sys.exit(1)
+    mode = sys.argv[1]
+    args = sys.argv[2:]
+    delay = int(args[0]) if len(args) > 0 else 0
+    dur = int(args[1]) if len(args) > 1 else 1
+    n_null = int(args[2]) if len(args) > 2 else A.N_NULL
+    autoenc = int(args[3]) if len(args) > 3 else 0
+    svdmap = min(max(float(args[4]), 0.0), 1.0) if len(args) > 4 else 0.0
+    n_jobs = int(args[5]) if len(args) > 5 else None
+    overwrite = int(args[6]) if len(args) > 6 else 0
+    if mode == 'qsub' and os.path.exists(opj(BATCHDIR, 'submit.sh')):
+        os.remove(opj(BATCHDIR, 'submit.sh')) # never resubmit an earlier run's batches
+    units = get_work_units(delay=delay, dur=dur, n_null=n_null, autoenc=autoenc, svdmap=svdmap, overwrite=overwrite)
+    print("%d work units remaining in %s"%(len(units), get_resultdir(delay, dur, n_null, autoenc, svdmap)))
+    if not units:
+        sys.exit(0)
+    if mode == 'local':
+        run_local(units, delay, dur, n_null, autoenc, svdmap, n_jobs)
+    else:
+        fnames = write_batches(units, len(A.subjects) if n_jobs is None else n_jobs, delay, dur, n_null, autoenc, svdmap, overwrite)
+        print("wrote %d batch jobs, submit with: . %s"%(len(fnames), opj(BATCHDIR, 'submit.sh')))